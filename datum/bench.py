@@ -0,0 +1,152 @@
+"""Benchmark a query: run it many times and report the latency distribution.
+
+The results are fetched in full, but never printed, so the numbers reflect the
+server and the driver and not how fast the terminal is.
+"""
+from . import connect
+from . import printer
+from concurrent.futures import ThreadPoolExecutor
+from pyodbc import ProgrammingError
+import math
+import statistics
+import threading
+import time
+
+_config = {}
+
+_batch_size = 10000
+
+
+def initialize_module(config):
+    """Initialize this module with a reference to the global config."""
+    global _config
+    _config = config
+
+
+def run(query, params, runs, warmup, concurrency):
+    """Execute query runs times and print the timing stats.
+
+    Each run uses the same params. With concurrency > 1 the runs are split
+    among that many connections, executing at the same time, and each of them
+    does its own warmup runs first.
+    Returns the total of rows fetched in the measured runs.
+    """
+    print('Running ', runs, ' times (', warmup, ' warmup) on ', concurrency,
+          ' connection', "s" if concurrency > 1 else "", '...', sep="",
+          flush=True)
+    if concurrency == 1:
+        connections = [connect.get_connection()]
+    else:
+        connections = [connect.open_connection()
+                       for _ in range(concurrency)]
+    # All the workers start measuring at the same time, after warming up
+    ready = threading.Barrier(concurrency)
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = [pool.submit(_run_worker, connection, query, params,
+                                   runs // concurrency
+                                   + (number < runs % concurrency),
+                                   warmup, ready)
+                       for number, connection in enumerate(connections)]
+            results = [_result(future) for future in futures]
+    finally:
+        if concurrency > 1:
+            for connection in connections:
+                connection.close()
+    errors = [result for result in results if isinstance(result, Exception)]
+    # When a worker fails, the rest are stopped at the barrier. The error that
+    # matters is the original one
+    errors.sort(key=lambda err: isinstance(err, threading.BrokenBarrierError))
+    if errors:
+        raise errors[0]
+    timings = [timing for worker_timings, _ in results
+               for timing in worker_timings]
+    elapsed = max(worker_elapsed for _, worker_elapsed in results)
+    _print_stats(timings, elapsed)
+    return sum(rows for _, _, rows in timings)
+
+
+def _result(future):
+    """The result of the future, or the exception it raised."""
+    try:
+        return future.result()
+    except Exception as err:
+        return err
+
+
+def _run_worker(connection, query, params, runs, warmup, ready):
+    """Run the query in a connection, and return the timing of each run.
+
+    Timings are tuples of (execute seconds, fetch seconds, rows). The total
+    time for the measured runs is returned too.
+    """
+    cursor = connection.cursor()
+    try:
+        for _ in range(warmup):
+            cursor.execute(query, params)
+            _drain(cursor)
+    except Exception:
+        ready.abort()
+        raise
+    ready.wait()
+    measure_start = time.perf_counter()
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        cursor.execute(query, params)
+        executed = time.perf_counter()
+        rows = _drain(cursor)
+        timings.append((executed - start, time.perf_counter() - executed,
+                        rows))
+    return timings, time.perf_counter() - measure_start
+
+
+def _drain(cursor):
+    """Fetch all the rows of all the resultsets in cursor, return the count."""
+    rows = 0
+    while True:
+        try:
+            batch = cursor.fetchmany(_batch_size)
+            while batch:
+                rows += len(batch)
+                batch = cursor.fetchmany(_batch_size)
+        except ProgrammingError as e:
+            if "Previous SQL was not a query." not in str(e):
+                raise e
+        if not cursor.nextset():
+            return rows
+
+
+def _print_stats(timings, elapsed):
+    """Print the latency table and the throughput."""
+    if not timings:
+        print("No runs to report.")
+        return
+    execute = [timing[0] for timing in timings]
+    fetch = [timing[1] for timing in timings]
+    total = [timing[0] + timing[1] for timing in timings]
+    rows = sum(timing[2] for timing in timings)
+    table = [(name, *(f"{value * 1000:.2f}" for value in _summary(values)))
+             for name, values in (("execute", execute),
+                                  ("fetch", fetch),
+                                  ("total", total))]
+    printer.print_table(["ms", "min", "median", "p95", "p99", "max"], table)
+    fetch_time = sum(fetch)
+    print("\nRuns: ", len(timings), ", rows per run: ",
+          rows // len(timings), ", rows/s (fetch): ",
+          f"{rows / fetch_time:,.0f}" if fetch_time else "-",
+          ", runs/s: ", f"{len(timings) / elapsed:,.1f}" if elapsed else "-",
+          sep="")
+
+
+def _summary(values):
+    """min, median, p95, p99 and max of values."""
+    values = sorted(values)
+    return (values[0], statistics.median(values), _percentile(values, 95),
+            _percentile(values, 99), values[-1])
+
+
+def _percentile(sorted_values, percent):
+    """Nearest-rank percentile, sorted_values must be, well, sorted."""
+    rank = math.ceil(percent / 100 * len(sorted_values))
+    return sorted_values[max(rank, 1) - 1]
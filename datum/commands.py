@@ -5,6 +5,11 @@ This module deals with built-in commands (:rows, :reconnect, etc.) and
 processing of custom queries.
 """
 from . import connect
+from . import exporter
+from . import local
+from . import memory
+from . import printer
+from . import store
 from string import Formatter as _Formatter
 import os
 
@@ -17,6 +22,12 @@ _help_text = """
 :rows [number]    How many rows to print out of the resultset. Call with no
                   number to see the current value. Use 0 for "all rows".
 
+:more [number]    Print the next rows of the last query, when not all of them
+                  were printed. Defaults to the :rows value.
+
+:rest             Print the remaining rows of the last query, or export them
+                  if there's a CSV target.
+
 :chars [number]   How many chars per column to print. Call with no number to
                   see the current value. Use 0 to not truncate.
 
@@ -37,11 +48,90 @@ _help_text = """
 
 :reconnect        Force a new connection to the server, discarding the old one.
 
+:tx [ON|number|OFF] [semicolons]
+                  Turn autocommit off, split queries and scripts in statements
+                  at GO lines and commit them in batches of this many. A
+                  failing batch is rolled back. With "semicolons" statements
+                  are split at ";" too, which breaks procedures and blocks.
+
+:cache [size|clear]
+                  Show how many times a cursor was reused to run the same
+                  query again. Set how many cursors to keep (0 disables the
+                  cache), or "clear" to discard them.
+
 :csv [path]       Export the query output to CSV file. Call with no arguments
                   to print results again.
 
+:rotate [rows number] [size number[K|M|G]]
+                  Split CSV exports in numbered files of at most this many
+                  rows and/or bytes, plus a manifest. Use "OFF" to disable.
+
 :script [path]    Read a script from a file. The input is processed as a custom
                   command, with support for {placeholders} and ? ODBC params.
+
+:partition [count column [range|mod] [merge]]
+                  Split CSV exports in partitions by column, each one running
+                  on its own connection. Use "range" (default) for numeric or
+                  date keys, "mod" for integer keys. "merge" joins the files
+                  in key order (range only). Use "OFF" to disable.
+
+:fanout [group]   Run queries on all the connections of a group declared in
+                  the config file, with a leading "source" column in the
+                  results. Call with no args to see the current group, use
+                  "OFF" to go back to the current connection.
+
+:diff [connection keys]
+                  Run queries in the current connection and in another one
+                  from the config file, and show only the rows that differ.
+                  keys is a comma separated list of the columns that identify
+                  a row. Use "OFF" to disable.
+
+:materialize [table [columns...]]
+                  Copy the results of the next query into a table of the
+                  local database. Each extra argument is an index, use commas
+                  for multiple columns: :materialize orders id cust,dt
+
+:local [ON|OFF]   Send queries to the local database instead of the server.
+                  Call with no args to see the current status and tables.
+
+:keep [ON|OFF]    Keep all the rows of the next queries in memory (the last
+                  resultset of each), to explore them with the subcommands
+                  below. Call with no args to see the current status.
+
+:keep sort column [desc] [column [desc]...]
+                  Sort the rows kept and print the first ones.
+
+:keep where [column operator value|OFF]
+                  Filter the rows kept, operator is one of =, !=, <, <=, >,
+                  >= or ~ (contains). Filters add up, use "OFF" to see all the
+                  rows again.
+
+:keep group column [count|sum|avg|min|max column]
+                  Print the distinct values of a column in the rows kept, with
+                  how many rows have each one, and optionally an aggregate.
+
+:keep top [number]
+                  Print the first rows kept, after where and sort.
+
+:bench runs [warmup=n] [concurrency=n] [query or :command]
+                  Execute a query (or the next one) many times without
+                  printing, and report timing stats. With concurrency the runs
+                  are split among that many connections.
+
+:profile [top=n] [query or :command]
+                  Read all the rows of a query (or the next one) once, and
+                  print the NULLs, min, max, average length, approximate
+                  distinct count and most frequent values of each column.
+
+:watch [seconds [keys]]
+                  Run the next query every few seconds, printing only the rows
+                  inserted, removed or changed. keys is a comma separated list
+                  of the columns that identify a row. Stop with Ctrl-C.
+
+:mem [ON|OFF] [limit MB|OFF]
+                  Report the memory used by each resultset printed or
+                  exported. "limit" sets a ceiling for the process memory,
+                  fetching stops when it is reached.
 """
 
 
@@ -107,6 +197,46 @@ def rows(args):
     print('Printing', display_value, 'rows of each resulset.')
 
 
+def more(args):
+    """Built-in :more command.
+
+    Print the next page of the results that were left pending, by default as
+    many rows as :rows.
+    """
+    global _config
+    count = _config["rows_to_print"]
+    if args:
+        try:
+            count = int(args[0])
+            if count < 1:
+                raise ValueError("A page has at least one row")
+        except ValueError:
+            print("Usage: :more [rows]")
+            return
+    if not count:
+        # :rows 0 prints everything, which is what :rest is for
+        printer.print_rest()
+        return
+    printer.print_more(count)
+
+
+def rest(args):
+    """Built-in :rest command.
+
+    Print all the results that were left pending, or export them if there's a
+    CSV target.
+    """
+    global _config
+    if not _config["csv_path"]:
+        printer.print_rest()
+        return
+    pending_cursor = printer.take_pending()
+    if not pending_cursor:
+        print("There are no pending results.")
+        return
+    exporter.export_cursor_results(pending_cursor)
+
+
 def chars(args):
     """Built-in :chars command."""
     global _config
@@ -187,11 +317,77 @@ def timeout(args):
                 raise ValueError("Why are you trying to break me...")
             connection.timeout = new_value
             _config["command_timeout"] = new_value
+            # Cursors get the timeout when created, so start from scratch
+            printer.release_pending()
+            connect.clear_cursor_cache()
         except ValueError:
             pass
     print("Command timeout set to", connection.timeout, "seconds.")
 
 
+def tx(args):
+    """Built-in :tx command.
+
+    Set the batch options in the config dictionary's 'transaction' key, and
+    turn autocommit off. In the main loop queries are split in statements,
+    and committed in batches.
+    """
+    global _config
+    if args and args[0] == "OFF":
+        _config["transaction"] = None
+        connect.set_autocommit(True)
+    elif args:
+        try:
+            if args[0] == "ON":
+                batch_size = _config["transaction_batch_size"]
+            else:
+                batch_size = int(args[0])
+            if batch_size < 1 or args[1:] not in ([], ["semicolons"]):
+                raise ValueError("Why are you trying to break me...")
+        except ValueError:
+            print("Usage: :tx [ON|batch size|OFF] [semicolons]")
+            return
+        # Results pending would keep the connection busy
+        printer.release_pending()
+        connect.set_autocommit(False)
+        _config["transaction"] = {"batch_size": batch_size,
+                                  "semicolons": args[1:] == ["semicolons"]}
+
+    settings = _config["transaction"]
+    if settings:
+        print("Statements are committed in batches of",
+              settings["batch_size"], "statements, split at GO lines",
+              "and ;" if settings["semicolons"] else "only")
+    else:
+        print("Autocommit is on, each statement is committed on its own.")
+
+
+def cache(args):
+    """Built-in :cache command."""
+    if args and args[0] == "clear":
+        printer.release_pending()
+        connect.clear_cursor_cache()
+    elif args:
+        try:
+            new_value = int(args[0])
+            if new_value < 0:
+                raise ValueError("Why are you trying to break me...")
+            printer.release_pending()
+            connect.set_cursor_cache_size(new_value)
+        except ValueError:
+            print("Usage: :cache [size|clear]")
+            return
+    stats = connect.cursor_cache_stats()
+    if not stats["limit"]:
+        print("Cursor cache disabled.")
+        return
+    lookups = stats["hits"] + stats["misses"]
+    print("Cursor cache: ", stats["size"], "/", stats["limit"], " cursors, ",
+          stats["hits"], " hits, ", stats["misses"], " misses",
+          f" ({stats['hits'] / lookups:.0%} hit rate)" if lookups else "",
+          sep="")
+
+
 def csv_setup(args):
     """Built-in :csv command.
 
@@ -219,6 +415,398 @@ def csv_setup(args):
         print("Disabled CSV writing")
 
 
+def partition(args):
+    """Built-in :partition command.
+
+    Set the partitioning options in the config dictionary's 'partition' key.
+    They are used in the main loop, when exporting to CSV.
+    """
+    global _config
+    if args and args[0] == "OFF":
+        _config["partition"] = None
+    elif args:
+        try:
+            count = int(args[0])
+            if count < 2:
+                raise ValueError("One partition is a regular export...")
+            column = args[1]
+            options = args[2:]
+            mode = "mod" if "mod" in options else "range"
+            merge = "merge" in options
+            if merge and mode == "mod":
+                print("Only range partitions can be merged in key order.")
+                return
+            _config["partition"] = {"count": count,
+                                    "column": column,
+                                    "mode": mode,
+                                    "merge": merge}
+        except (ValueError, IndexError):
+            print("Usage: :partition count column [range|mod] [merge]")
+            return
+
+    settings = _config["partition"]
+    if not settings:
+        print("Partitioned export disabled.")
+        return
+    print('Exporting in', settings["count"], 'partitions by', settings["mode"],
+          'of', settings["column"], end="")
+    print(', merged into one file.' if settings["merge"] else
+          ', one file per partition.')
+    if not _config["csv_path"]:
+        print("Partitioning applies only to exports, see :csv.")
+
+
+def fanout(args):
+    """Built-in :fanout command.
+
+    Set the group name in the config dictionary's 'fanout' key. The main loop
+    runs queries on all the connections in the group while it is set.
+    """
+    global _config
+    groups = _config["fanout_groups"]
+    if args and args[0] == "OFF":
+        _config["fanout"] = None
+    elif args:
+        if args[0] not in groups:
+            print('Unknown group "', args[0], '". Groups are declared in ',
+                  '[fanout.<group>] sections of the config file.', sep="")
+            return
+        _config["fanout"] = args[0]
+
+    if _config["fanout"]:
+        print('Running queries on the ',
+              len(groups[_config["fanout"]]), ' connections of "',
+              _config["fanout"], '"', sep="")
+    else:
+        print("Running queries on the current connection.")
+        if groups:
+            print("Available groups:", ", ".join(groups))
+
+
+def diff(args):
+    """Built-in :diff command.
+
+    Set the connection and key columns in the config dictionary's 'diff' key.
+    The main loop compares the results of queries while it is set.
+    """
+    global _config
+    connections = _config["connections"]
+    if args and args[0] == "OFF":
+        _config["diff"] = None
+    elif args:
+        if args[0] not in connections:
+            print('Unknown connection "', args[0], '". Connections are ',
+                  'declared in the [connections] section of the config file.',
+                  sep="")
+            return
+        # Accept both "a,b" and "a b"
+        keys = [key for arg in args[1:] for key in arg.split(",") if key]
+        if not keys:
+            print("Usage: :diff connection key1,key2,...")
+            return
+        _config["diff"] = {"connection": args[0], "keys": keys}
+
+    if _config["diff"]:
+        print('Comparing query results against "',
+              _config["diff"]["connection"], '" by ',
+              ", ".join(_config["diff"]["keys"]), sep="")
+    else:
+        print("Comparison of results disabled.")
+        if connections:
+            print("Available connections:", ", ".join(connections))
+
+
+def materialize(args):
+    """Built-in :materialize command.
+
+    Set the table name and indexes in the config dictionary's 'materialize'
+    key. The main loop copies the results of the next query to the local
+    database, and clears it.
+    """
+    global _config
+    if args:
+        indexes = [arg.split(",") for arg in args[1:]]
+        _config["materialize"] = {"table": args[0], "indexes": indexes}
+        print('The next query will be copied to local table "', args[0], '"',
+              sep="")
+    else:
+        _config["materialize"] = None
+        print("No query will be materialized.")
+
+
+def local_switch(args):
+    """Built-in :local command."""
+    global _config
+    if args and args[0] == "ON":
+        _config["local"] = True
+    elif args and args[0] == "OFF":
+        _config["local"] = False
+
+    print('Local database "', local.get_path(), '"', sep="")
+    tables = local.table_names()
+    print("Tables:", ", ".join(tables) if tables else "(none)")
+    if _config["local"]:
+        print("Queries are sent to the local database.")
+    else:
+        print("Queries are sent to the server.")
+
+
+def keep(args):
+    """Built-in :keep command.
+
+    Besides turning the mode ON/OFF, the actions on the results kept (sort,
+    where, group and top) are subcommands, so they don't take names from the
+    custom commands.
+    """
+    global _config
+    if args and args[0] in _keep_actions:
+        action, *action_args = args
+        if _check_kept():
+            _keep_actions[action](action_args)
+        return
+    if args and args[0] == "ON":
+        _config["keep"] = True
+    elif args and args[0] == "OFF":
+        _config["keep"] = False
+    elif args:
+        print("Usage: :keep [ON|OFF|sort|where|group|top ...]")
+        return
+
+    print(store.summary())
+    if _config["keep"]:
+        print("The results of the next queries are kept in memory.")
+    else:
+        print("Results are not kept.")
+
+
+def _keep_sort(args):
+    """:keep sort subcommand."""
+    if not args:
+        print("Usage: :keep sort column [desc] [column [desc]...]")
+        return
+    keys = []
+    for arg in args:
+        if arg.lower() in ("asc", "desc") and keys:
+            keys[-1] = (keys[-1][0], arg.lower() == "desc")
+        else:
+            keys.append((arg, False))
+    store.sort(keys)
+
+
+def _keep_where(args):
+    """:keep where subcommand."""
+    if not args:
+        print(store.summary())
+    elif args[0] == "OFF":
+        store.reset()
+    elif len(args) < 3:
+        print("Usage: :keep where column =|!=|<|<=|>|>=|~ value")
+    else:
+        store.where(args[0], args[1], " ".join(args[2:]))
+
+
+def _keep_group(args):
+    """:keep group subcommand."""
+    if len(args) not in (1, 3):
+        print("Usage: :keep group column [count|sum|avg|min|max column]")
+        return
+    store.group(*args)
+
+
+def _keep_top(args):
+    """:keep top subcommand."""
+    global _config
+    count = _config["rows_to_print"]
+    if args:
+        try:
+            count = int(args[0])
+            if count < 0:
+                raise ValueError("Why are you trying to break me...")
+        except ValueError:
+            print("Usage: :keep top [rows]")
+            return
+    store.top(count)
+
+
+_keep_actions = {"sort": _keep_sort,
+                 "where": _keep_where,
+                 "group": _keep_group,
+                 "top": _keep_top}
+
+
+def _check_kept():
+    """Helper for the commands that work on the results kept."""
+    if store.is_loaded():
+        return True
+    print("No results kept, use :keep ON and run a query.")
+    return False
+
+
+def bench(args):
+    """Built-in :bench command.
+
+    Set the benchmark options in the config dictionary's 'bench' key, the main
+    loop benchmarks the next query and clears it. If there's a query (or a
+    custom command) after the options, it is returned to run right away.
+    """
+    global _config
+    options = {"runs": 0, "warmup": 0, "concurrency": 1}
+    try:
+        options["runs"] = int(args[0])
+        rest = args[1:]
+        while rest and "=" in rest[0] and rest[0].split("=")[0] in options:
+            name, value = rest.pop(0).split("=")
+            options[name] = int(value)
+        if (options["runs"] < 1 or options["warmup"] < 0
+                or options["concurrency"] < 1):
+            raise ValueError("Why are you trying to break me...")
+    except (ValueError, IndexError):
+        print("Usage: :bench runs [warmup=n] [concurrency=n] "
+              "[query or :command]")
+        return
+    _config["bench"] = options
+    if not rest:
+        print("The next query will be benchmarked.")
+        return
+    query = " ".join(rest)
+    if query.startswith(":"):
+        query = handle(query)
+        if not query:
+            # Not a command that returns a query
+            _config["bench"] = None
+    return query
+
+
+def profile(args):
+    """Built-in :profile command.
+
+    Set the options in the config dictionary's 'profile' key, the main loop
+    profiles the next query and clears it. Like :bench, the query (or a
+    custom command) can follow the options.
+    """
+    global _config
+    options = {"top": 3}
+    rest = list(args)
+    try:
+        if rest and rest[0].startswith("top="):
+            options["top"] = int(rest.pop(0)[4:])
+            if options["top"] < 0:
+                raise ValueError("Why are you trying to break me...")
+    except ValueError:
+        print("Usage: :profile [top=n] [query or :command]")
+        return
+    _config["profile"] = options
+    if not rest:
+        print("The next query will be profiled.")
+        return
+    query = " ".join(rest)
+    if query.startswith(":"):
+        query = handle(query)
+        if not query:
+            # Not a command that returns a query
+            _config["profile"] = None
+    return query
+
+
+def watch(args):
+    """Built-in :watch command.
+
+    Set the interval and keys in the config dictionary's 'watch' key, the
+    main loop runs the next query on a timer, and clears it.
+    """
+    global _config
+    if not args:
+        _config["watch"] = None
+        print("The next query will run once.")
+        return
+    try:
+        interval = float(args[0])
+        if interval <= 0:
+            raise ValueError("Why are you trying to break me...")
+    except ValueError:
+        print("Usage: :watch seconds [key1,key2,...]")
+        return
+    keys = [key for arg in args[1:] for key in arg.split(",") if key]
+    _config["watch"] = {"interval": interval, "keys": keys}
+    print("The next query will run every", args[0], "seconds.")
+
+
+def mem(args):
+    """Built-in :mem command."""
+    global _config
+    try:
+        if args and args[0] in ("ON", "OFF"):
+            memory.set_tracking(args.pop(0) == "ON")
+        if args and args[0] == "limit":
+            if args[1] == "OFF":
+                _config["memory_limit"] = 0
+            else:
+                new_value = int(args[1])
+                if new_value < 0:
+                    raise ValueError("Why are you trying to break me...")
+                _config["memory_limit"] = new_value * 1024 * 1024
+    except (ValueError, IndexError):
+        print("Usage: :mem [ON|OFF] [limit MB|OFF]")
+        return
+
+    print("Memory report", "ON" if _config["memory_tracking"] else "OFF",
+          end=". ")
+    if _config["memory_limit"]:
+        print("Ceiling:", memory.format_size(_config["memory_limit"]),
+              end=". ")
+    else:
+        print("No ceiling.", end=" ")
+    print("Current RSS:", memory.format_size(memory.rss()))
+    if _config["memory_limit"] and memory.rss() is None:
+        print("WARNING: the current memory of the process isn't available in",
+              "this platform, the ceiling won't apply.")
+
+
+def rotate(args):
+    """Built-in :rotate command.
+
+    Set the 'rotate_rows' and 'rotate_bytes' keys in the config dictionary,
+    the exporter reads them to decide when to start a new file.
+    """
+    global _config
+    if args and args[0] == "OFF":
+        _config["rotate_rows"] = 0
+        _config["rotate_bytes"] = 0
+    elif args:
+        try:
+            options = dict(zip(args[::2], args[1::2]))
+            if not options or set(options) - {"rows", "size"}:
+                raise ValueError("Unknown option")
+            rows = int(options.get("rows", 0))
+            size = _parse_size(options.get("size", "0"))
+            if rows < 0 or size < 0:
+                raise ValueError("Why are you trying to break me...")
+            _config["rotate_rows"] = rows
+            _config["rotate_bytes"] = size
+        except ValueError:
+            print("Usage: :rotate [rows number] [size number[K|M|G]]")
+            return
+
+    if not (_config["rotate_rows"] or _config["rotate_bytes"]):
+        print("CSV exports are written to a single file.")
+        return
+    limits = []
+    if _config["rotate_rows"]:
+        limits.append(f'{_config["rotate_rows"]} rows')
+    if _config["rotate_bytes"]:
+        limits.append(f'{_config["rotate_bytes"]} bytes')
+    print("CSV exports are split in files of at most", " and ".join(limits))
+
+
+def _parse_size(text):
+    """Parse a size like 100, 512K, 20M or 2G, into bytes."""
+    multipliers = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    text = text.upper()
+    if text[-1:] in multipliers:
+        return int(text[:-1]) * multipliers[text[-1]]
+    return int(text)
+
+
 def read_script(args):
     """Built-in :script command.
 
@@ -249,6 +837,9 @@ def reconnect(args):
     """Built-in :reconnect command."""
     # Since the timeout command modified the config dict, and the timeout in
     # the function below is picked up from the same place...
+    # Results pending from the old connection can't be fetched anymore, and
+    # the connection might be broken, so just forget about them
+    printer.take_pending()
     connect.get_connection(force_new=True)
     # if get_connection throws, this message won't print
     print("Opened new connection.")
@@ -256,6 +847,18 @@ def reconnect(args):
     return
 
 
+def count_parameters(query):
+    """Count the ? ODBC parameters in the query text."""
+    # My thinking here is that  we should count "?" next to a space and
+    # next to an operator. Ex: " ? ", ",?", "=?" Not sure if that is safe
+    # enough, but it seems better than plainly counting "?" like sqlcmdline
+    # used to do, so, it is an improvement.
+    param_count = query.count(" ?")
+    param_count += query.count(",?")
+    param_count += query.count("=?")
+    return param_count
+
+
 def prepare_query(template):
     """Replace the {} placeholders in a query template with user input."""
     f = _Formatter()
@@ -288,11 +891,26 @@ def _args_to_abspath(args):
 
 _builtins = {":help": help_text,
              ":rows": rows,
+             ":more": more,
+             ":rest": rest,
              ":chars": chars,
              ":null": null,
              ":newline": newline,
              ":tab": tab,
              ":timeout": timeout,
              ":csv": csv_setup,
+             ":rotate": rotate,
              ":script": read_script,
+             ":partition": partition,
+             ":fanout": fanout,
+             ":diff": diff,
+             ":materialize": materialize,
+             ":local": local_switch,
+             ":keep": keep,
+             ":bench": bench,
+             ":mem": mem,
+             ":watch": watch,
+             ":profile": profile,
+             ":tx": tx,
+             ":cache": cache,
              ":reconnect": reconnect}
@@ -1,4 +1,5 @@
 """Contains all the setup for new connections to the database."""
+from collections import OrderedDict
 import pyodbc
 import struct
 
@@ -13,6 +14,16 @@ _user = None
 _pass = None
 _integrated = False
 _timeout = 30
+# Turned off while in :tx mode, and kept that way across reconnections
+_autocommit = True
+
+# Cursors of the session's connection, by query text, most recently used last.
+# pyodbc prepares a statement once per cursor, and executing the same text
+# again with different parameters skips that step
+_cursors = OrderedDict()
+_cursor_cache_size = 16
+_cache_hits = 0
+_cache_misses = 0
 
 # The first newline here is useful for spacing later
 _header_message = """
@@ -26,7 +37,8 @@ a new line or ";;" at the end of a query.
 def initialize_module(docopt_args, config):
     """Construct/deconstruct the connection string for the current session."""
     global _conn_string, _driver, _dsn, _server, _database, _user, _pass
-    global _integrated, _timeout
+    global _integrated, _timeout, _cursor_cache_size
+    _cursor_cache_size = config["cursor_cache_size"]
     _conn_string = docopt_args["--conn-string"]
     if docopt_args["--conn-string"]:
         # We will use the connection string as-is
@@ -85,15 +97,117 @@ def get_connection(force_new=False):
 
     # As per https://github.com/mkleehammer/pyodbc/issues/43 we don't need to
     # explicitly close the old connection, if there was one. So we don't check.
-    _connection = pyodbc.connect(_conn_string, autocommit=True)
-    _connection.add_output_converter(-155, _handle_datetimeoffset)
+    # The cached cursors belong to it, though.
+    clear_cursor_cache()
+    _connection = open_connection()
+    if not _autocommit:
+        _connection.autocommit = False
+    return _connection
+
+
+def get_dbms_name(connection=None):
+    """Name of the DB engine of connection, as the driver says.
+
+    connection defaults to the session's connection. Returns an empty string
+    if the driver doesn't tell.
+    """
+    try:
+        connection = connection or get_connection()
+        return connection.getinfo(pyodbc.SQL_DBMS_NAME) or ""
+    except pyodbc.Error:
+        return ""
+
+
+def set_autocommit(enabled):
+    """Turn autocommit on or off for the session's connection.
+
+    Turning it on commits the open transaction, if any.
+    """
+    global _autocommit
+    _autocommit = enabled
+    if _connection:
+        _connection.autocommit = enabled
+
+
+def get_cursor(query):
+    """Return a cursor of the session's connection to execute query.
+
+    If the same query text ran recently, its cursor is reused so the server
+    doesn't have to prepare the statement again. Only the last
+    _cursor_cache_size queries are remembered.
+    """
+    global _cursors, _cache_hits, _cache_misses
+    connection = get_connection()
+    if not _cursor_cache_size:
+        return connection.cursor()
+    cursor = _cursors.get(query)
+    if cursor:
+        _cache_hits += 1
+        _cursors.move_to_end(query)
+        return cursor
+    _cache_misses += 1
+    cursor = connection.cursor()
+    _cursors[query] = cursor
+    _trim_cursor_cache()
+    return cursor
+
+
+def cursor_cache_stats():
+    """Return a dict with the size, limit, hits and misses of the cache."""
+    return {"size": len(_cursors),
+            "limit": _cursor_cache_size,
+            "hits": _cache_hits,
+            "misses": _cache_misses}
+
+
+def set_cursor_cache_size(size):
+    """Change how many cursors are kept, 0 disables the cache."""
+    global _cursor_cache_size
+    _cursor_cache_size = size
+    _trim_cursor_cache()
+
+
+def clear_cursor_cache():
+    """Close all the cached cursors, and reset the stats."""
+    global _cursors, _cache_hits, _cache_misses
+    while _cursors:
+        _, cursor = _cursors.popitem(last=False)
+        _close_cursor(cursor)
+    _cache_hits = 0
+    _cache_misses = 0
+
+
+def _trim_cursor_cache():
+    while len(_cursors) > _cursor_cache_size:
+        _, cursor = _cursors.popitem(last=False)
+        _close_cursor(cursor)
+
+
+def _close_cursor(cursor):
     try:
-        _connection.timeout = _timeout
+        cursor.close()
+    except pyodbc.Error:
+        # The connection might be gone already, nothing to free then
+        pass
+
+
+def open_connection(conn_string=None):
+    """Open a new connection, independent of the one used by the session.
+
+    Uses the session's connection string unless another one is provided. The
+    commands that need more than one connection at a time get theirs here.
+    """
+    global _conn_string, _timeout
+
+    connection = pyodbc.connect(conn_string or _conn_string, autocommit=True)
+    connection.add_output_converter(-155, _handle_datetimeoffset)
+    try:
+        connection.timeout = _timeout
     except Exception as e:
         # Connecting to Excel files using ODBC, it said "Optional feature not
         # implemented". So if the timeout can't be set, just print a message
         print('WARNING: command timeout not set')
-    return _connection
+    return connection
 
 
 def _build_connection_string():
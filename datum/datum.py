@@ -5,6 +5,16 @@ from . import environment
 from . import printer
 from . import exporter
 from . import commands
+from . import partition
+from . import fanout
+from . import diff
+from . import local
+from . import bench
+from . import memory
+from . import watch
+from . import store
+from . import profile
+from . import transaction
 
 # The configuration read using environment.get_config_dict and referenced in
 # this variable is, in fact, shared by all the modules. This allows the
@@ -21,6 +31,16 @@ def initialize(args):
     connect.initialize_module(args, config)
     printer.initialize_module(config)
     exporter.initialize_module(config)
+    partition.initialize_module(config)
+    fanout.initialize_module(config)
+    diff.initialize_module(config)
+    local.initialize_module(config)
+    bench.initialize_module(config)
+    memory.initialize_module(config)
+    watch.initialize_module(config)
+    store.initialize_module(config)
+    profile.initialize_module(config)
+    transaction.initialize_module(config)
     commands.initialize_module(config)
     # we don't _need_ to connect now, but it is a good place to blow up
     # if the parameters we have aren't good
@@ -47,20 +67,18 @@ def query_loop():
             # input if it wasn't a command, OR empty if it was handled and
             # there's nothing else to do, OR a formatted query
             if query:
-                cursor = connect.get_connection().cursor()
                 params = prompt_parameters(query)
-                cursor.execute(query, params)
-                row_count = cursor.rowcount
-                if config["csv_path"]:
-                    exporter.export_cursor_results(cursor)
-                else:
-                    # the default operation
-                    printer.print_cursor_results(cursor)
+                row_count = run_query(query, params)
                 print("\nRows affected:", row_count)
         except Exception as err:
             # Oracle tends to return lengthy error messages with non-printable
             # characters that break datum. Print only the first line for those.
-            code, message, *_ = err.args
+            # Errors raised by datum itself (and not by the ODBC driver) don't
+            # have a code, the message is all there is.
+            if len(err.args) > 1:
+                code, message, *_ = err.args
+            else:
+                code, message = "-", str(err)
             if f'[{code}] [Oracle]' in message:
                 message = message[0:message.index("\n")]
             print("---ERROR---\n"
@@ -71,6 +89,90 @@ def query_loop():
         query = prompt_for_query_or_command()
 
 
+def run_query(query, params):
+    """Execute a query and send the results wherever they should go.
+
+    Most of the time this means the printer, but the commands can change that
+    via the config dictionary. Returns the row count reported by the driver.
+    """
+    global config
+    # Any results left for :more are gone, the connection is needed for this
+    # query
+    printer.release_pending()
+    if config["transaction"]:
+        settings = config["transaction"]
+        _check_transaction_modes()
+        return transaction.run(query, params, settings["batch_size"],
+                               settings["semicolons"])
+    if config["materialize"]:
+        # This one is good for a single query
+        settings = config["materialize"]
+        config["materialize"] = None
+        return local.materialize(query, params, settings["table"],
+                                 settings["indexes"])
+    if config["bench"]:
+        settings = config["bench"]
+        config["bench"] = None
+        return bench.run(query, params, settings["runs"], settings["warmup"],
+                         settings["concurrency"])
+    if config["watch"]:
+        settings = config["watch"]
+        config["watch"] = None
+        return watch.run(query, params, settings["interval"],
+                         settings["keys"])
+    if config["profile"]:
+        settings = config["profile"]
+        config["profile"] = None
+        return profile.run(query, params, settings["top"])
+
+    if config["local"]:
+        cursor = local.cursor()
+    elif config["fanout"]:
+        return fanout.run(config["fanout"], query, params)
+    elif config["diff"]:
+        return diff.run(query, params)
+    elif config["csv_path"] and config["partition"]:
+        return partition.export_partitioned(config["csv_path"], query, params)
+    else:
+        cursor = connect.get_cursor(query)
+    cursor.execute(query, params)
+    row_count = cursor.rowcount
+    if config["csv_path"]:
+        exporter.export_cursor_results(cursor)
+    elif config["keep"]:
+        # printed too, but all the rows are fetched and stay in memory
+        store.keep(cursor)
+    else:
+        # the default operation
+        printer.print_cursor_results(cursor)
+    return row_count
+
+
+def _check_transaction_modes():
+    """Refuse to run a query in :tx mode if other modes are active.
+
+    The statements run in the session's connection and the results are
+    printed, anything else would be ignored or (for the commands that run
+    queries on their own) leave work uncommitted. The modes that apply only
+    to the next query are cleared, since that query doesn't run.
+    """
+    global config
+    one_shot = [name for name in ("materialize", "bench", "watch", "profile")
+                if config[name]]
+    for name in one_shot:
+        config[name] = None
+    modes = [":" + name for name in one_shot]
+    modes += [command for command, key in ((":csv", "csv_path"),
+                                           (":fanout", "fanout"),
+                                           (":diff", "diff"),
+                                           (":keep", "keep"),
+                                           (":local", "local"))
+              if config[key]]
+    if modes:
+        raise ValueError(f"{', '.join(modes)} can't be used with :tx, the "
+                         f"query didn't run. Turn them off, or use :tx OFF.")
+
+
 def prompt_for_query_or_command():
     """Read the user's input, waiting for "query terminators" or commands."""
     global config
@@ -78,6 +180,12 @@ def prompt_for_query_or_command():
     # New in version 0.6: if output to file was request, add a "csv" to the
     # prompt string
     prompt = "csv>" if config["csv_path"] else ">"
+    # Same for queries that go to the local database
+    if config["local"]:
+        prompt = "local:" + prompt
+    # And for explicit transactions
+    if config["transaction"]:
+        prompt = "tx:" + prompt
     # Attempt to improve both the fix to issue #8 and printing speed, flush
     # output as little as possible, and include the prompt when doing so
     print(prompt, flush=True, end="")
@@ -103,15 +211,10 @@ def prompt_for_query_or_command():
 def prompt_parameters(query):
     """Analyze the query text and read as many parameters as needed.
 
-    The logic to detemine how many parameters to read is somewhat fragile.
+    The logic to detemine how many parameters to read is somewhat fragile,
+    see commands.count_parameters.
     """
-    # My thinking here is that  we should count "?" next to a space and
-    # next to an operator. Ex: " ? ", ",?", "=?" Not sure if that is safe
-    # enough, but it seems better than plainly counting "?" like sqlcmdline
-    # used to do, so, it is an improvement.
-    param_count = query.count(" ?")
-    param_count += query.count(",?")
-    param_count += query.count("=?")
+    param_count = commands.count_parameters(query)
     params = []
     if param_count > 0:
         # Add an empty line before asking for parameters, if any. This is a
@@ -0,0 +1,170 @@
+"""Compare the results of a query in two connections, in constant memory.
+
+The query runs at the same time in the session's connection and in a second
+connection declared in the [connections] section of the config file. Both
+resultsets are sorted by the key columns, so they can be compared with a
+merge, reading a batch at a time from each side. Only the rows that are
+different are printed (or exported).
+For the merge to work, both servers have to sort the keys the same way datum
+compares them: NULLs first, and text by code point. Engines don't agree on
+the first, and the default collations are rarely the second, so the ORDER BY
+says it explicitly.
+"""
+from . import connect
+from . import exporter
+from . import printer
+from . import streams
+from concurrent.futures import ThreadPoolExecutor
+
+_config = {}
+
+# How many rows to read from each side at a time
+_batch_size = 10000
+
+# How to sort a text column by code point (binary) in each engine, by a
+# lowercase piece of the name the driver reports
+_binary_order = (("microsoft sql server", "{} COLLATE Latin1_General_BIN2"),
+                 ("postgresql", '{} COLLATE "C"'),
+                 ("oracle", "NLSSORT({}, 'NLS_SORT=BINARY')"),
+                 ("mysql", "CAST({} AS BINARY)"),
+                 ("mariadb", "CAST({} AS BINARY)"),
+                 ("sqlite", "{} COLLATE BINARY"))
+
+
+def initialize_module(config):
+    """Initialize this module with a reference to the global config."""
+    global _config
+    _config = config
+
+
+def run(query, params):
+    """Run query in both connections, and print or export the differences.
+
+    The results have a leading "diff" column: "missing" for rows only in the
+    current connection, "extra" for rows only in the other connection, and a
+    pair of "changed <" and "changed >" rows (current and other connection)
+    when the keys match but the values don't.
+    Returns the count of rows that are different.
+    """
+    global _config
+    name = _config["diff"]["connection"]
+    keys = _config["diff"]["keys"]
+    # Wrap the query to sort it by the keys, this needs dropping the ";" the
+    # user typed to terminate it
+    query = query.strip().rstrip(';')
+    other_connection = connect.open_connection(_config["connections"][name])
+    try:
+        # The query runs in parallel in both servers, the comparison happens
+        # here as rows are fetched
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            other_execute = pool.submit(_execute_sorted, other_connection,
+                                        query, params, keys)
+            left = _execute_sorted(connect.get_connection(), query, params,
+                                   keys)
+            right = other_execute.result()
+        key_indexes = _key_indexes(left.description, right.description, keys)
+        counts = {"same": 0, "changed": 0, "missing": 0, "extra": 0}
+        differences = _compare(_fetch_rows(left), _fetch_rows(right),
+                               key_indexes, counts)
+        stream = streams.RowStream((streams.column("diff"),)
+                                   + tuple(left.description),
+                                   differences)
+        if _config["csv_path"]:
+            exporter.export_cursor_results(stream)
+        else:
+            printer.print_cursor_results(stream, pageable=False)
+        # The printer stops after :rows rows, but the counts need the full
+        # comparison
+        for _ in differences:
+            pass
+    finally:
+        other_connection.close()
+    print('\nDiff against "', name, '": ', counts["same"], ' same, ',
+          counts["changed"], ' changed, ', counts["missing"], ' missing, ',
+          counts["extra"], ' extra.', sep="")
+    return counts["changed"] + counts["missing"] + counts["extra"]
+
+
+def _execute_sorted(connection, query, params, keys):
+    """Run query in connection sorted by keys, return the cursor.
+
+    To know which keys are text, the query runs first with no rows.
+    """
+    cursor = connection.cursor()
+    cursor.execute(f"SELECT * FROM (\n{query}\n) datum_diff WHERE 1 = 0",
+                   params)
+    types = {column[0].lower(): column[1] for column in cursor.description}
+    dbms_name = connect.get_dbms_name(connection).lower()
+    text_order = next((order for name, order in _binary_order
+                       if name in dbms_name), "{}")
+    order = []
+    for key in keys:
+        column = (text_order.format(key) if types.get(key.lower()) is str
+                  else key)
+        order.append(f"CASE WHEN {key} IS NULL THEN 0 ELSE 1 END, {column}")
+    cursor.execute(f"SELECT * FROM (\n{query}\n) datum_diff "
+                   f"ORDER BY {', '.join(order)}", params)
+    return cursor
+
+
+def _key_indexes(left_description, right_description, keys):
+    """Validate that both sides have the same columns, and find the keys."""
+    left_names = [column[0].lower() for column in left_description]
+    right_names = [column[0].lower() for column in right_description]
+    if left_names != right_names:
+        raise ValueError("The query returned different columns in each "
+                         "connection.")
+    try:
+        return [left_names.index(key.lower()) for key in keys]
+    except ValueError:
+        raise ValueError("All the key columns must be part of the results.")
+
+
+def _fetch_rows(cursor):
+    """Generate the rows of cursor, fetching them in batches."""
+    rows = cursor.fetchmany(_batch_size)
+    while rows:
+        yield from rows
+        rows = cursor.fetchmany(_batch_size)
+
+
+def _compare(left_rows, right_rows, key_indexes, counts):
+    """Merge two sorted sequences of rows, generating the differences.
+
+    The counts dictionary is updated as the rows are compared.
+    """
+    def key(row):
+        # NULLs first, and comparable with everything else
+        return tuple((row[index] is not None, row[index])
+                     for index in key_indexes)
+
+    def next_row(rows, previous):
+        row = next(rows, None)
+        if row is not None and previous is not None and key(row) < previous:
+            raise ValueError("The rows didn't arrive sorted the way datum "
+                             "compares the keys. This happens with text keys "
+                             "in engines datum can't sort by code point.")
+        return row
+
+    left = next_row(left_rows, None)
+    right = next_row(right_rows, None)
+    while left is not None or right is not None:
+        left_key = key(left) if left is not None else None
+        right_key = key(right) if right is not None else None
+        if right is None or (left is not None and left_key < right_key):
+            counts["missing"] += 1
+            yield ("missing", *left)
+            left = next_row(left_rows, left_key)
+        elif left is None or right_key < left_key:
+            counts["extra"] += 1
+            yield ("extra", *right)
+            right = next_row(right_rows, right_key)
+        else:
+            if tuple(left) == tuple(right):
+                counts["same"] += 1
+            else:
+                counts["changed"] += 1
+                yield ("changed <", *left)
+                yield ("changed >", *right)
+            left = next_row(left_rows, left_key)
+            right = next_row(right_rows, right_key)
@@ -5,15 +5,41 @@ This includes not only env vars but also paths and configuration.
 import configparser
 import os
 
-# "csv_path" is set by the :csv command, it should default to None
+# "csv_path" is set by the :csv command, it should default to None, same for
+# "partition" and the :partition command, "fanout" with :fanout, "diff" with
+# :diff, "materialize" with :materialize, "bench" with :bench, "watch" with
+# :watch and "profile" with :profile. "local" is toggled by :local, "keep"
+# by :keep and "transaction" (the batch size) by :tx
 _default_config = {"rows_to_print": 50,
                    "column_display_length": 100,
                    "null_string": "[NULL]",
                    "newline_replacement": "[NL]",
                    "tab_replacement": "[TAB]",
                    "command_timeout": 30,
+                   "max_connections": 8,
+                   "local_database": None,
+                   "memory_tracking": False,
+                   "memory_limit": 0,
+                   "csv_encoder": "fast",
+                   "export_buffer_size": 1024 * 1024,
+                   "cursor_cache_size": 16,
+                   "transaction_batch_size": 1000,
                    "csv_path": None,
-                   "custom_commands": {}}
+                   "rotate_rows": 0,
+                   "rotate_bytes": 0,
+                   "partition": None,
+                   "fanout": None,
+                   "diff": None,
+                   "materialize": None,
+                   "local": False,
+                   "keep": False,
+                   "transaction": None,
+                   "bench": None,
+                   "watch": None,
+                   "profile": None,
+                   "custom_commands": {},
+                   "connections": {},
+                   "fanout_groups": {}}
 
 
 def resolve_envvar_args(args):
@@ -28,6 +54,20 @@ def resolve_envvar_args(args):
             args[key] = os.getenv(value[4:])
 
 
+def get_cache_path(filename):
+    """Return the path for filename in datum's cache directory.
+
+    Same logic as for the config directory, but following $XDG_CACHE_HOME.
+    The directory is created if it doesn't exist.
+    """
+    base_dir = os.getenv("XDG_CACHE_HOME")
+    if not base_dir:
+        base_dir = os.path.join(os.path.expanduser("~"), ".cache")
+    cache_dir = os.path.join(base_dir, "datum")
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, filename)
+
+
 def get_config_dict(commands_arg):
     """Find and open (if present) a configuration file.
 
@@ -89,10 +129,54 @@ def _read_config(config_file_path):
         "general",
         "command_timeout",
         fallback=_default_config["command_timeout"])
+    config["max_connections"] = config_file.getint(
+        "general",
+        "max_connections",
+        fallback=_default_config["max_connections"])
+    config["local_database"] = config_file.get(
+        "general",
+        "local_database",
+        fallback=_default_config["local_database"])
+    if config["local_database"]:
+        config["local_database"] = os.path.expanduser(
+            config["local_database"])
+    # The ceiling is in MB in the file, and in bytes everywhere else
+    config["memory_limit"] = config_file.getint(
+        "general",
+        "memory_limit",
+        fallback=_default_config["memory_limit"]) * 1024 * 1024
+    config["memory_tracking"] = _default_config["memory_tracking"]
+    config["csv_encoder"] = config_file.get(
+        "general",
+        "csv_encoder",
+        fallback=_default_config["csv_encoder"])
+    # The buffer is in KB in the file, and in bytes everywhere else
+    config["export_buffer_size"] = config_file.getint(
+        "general",
+        "export_buffer_size",
+        fallback=_default_config["export_buffer_size"] // 1024) * 1024
+    config["cursor_cache_size"] = config_file.getint(
+        "general",
+        "cursor_cache_size",
+        fallback=_default_config["cursor_cache_size"])
+    config["transaction_batch_size"] = config_file.getint(
+        "general",
+        "transaction_batch_size",
+        fallback=_default_config["transaction_batch_size"])
     config["custom_commands"] = {}
     if "queries" in config_file:
         for name in config_file["queries"]:
             config["custom_commands"][name] = config_file["queries"][name]
+    config["connections"] = {}
+    if "connections" in config_file:
+        for name in config_file["connections"]:
+            config["connections"][name] = config_file["connections"][name]
+    # Each [fanout.<group>] section is a group of connection strings
+    config["fanout_groups"] = {}
+    for section in config_file.sections():
+        if section.startswith("fanout."):
+            group = section[len("fanout."):]
+            config["fanout_groups"][group] = dict(config_file[section])
     # reading empty string from the config files ==> same as using the command
     # with the OFF option. So let's take care of that.
     if config["newline_replacement"] == "":
@@ -102,5 +186,17 @@ def _read_config(config_file_path):
 
     # "csv_path" is set by the :csv command, and cleared after each use
     config["csv_path"] = None
+    config["rotate_rows"] = 0
+    config["rotate_bytes"] = 0
+    config["partition"] = None
+    config["fanout"] = None
+    config["diff"] = None
+    config["materialize"] = None
+    config["local"] = False
+    config["keep"] = False
+    config["transaction"] = None
+    config["bench"] = None
+    config["watch"] = None
+    config["profile"] = None
 
     return config
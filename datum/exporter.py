@@ -1,6 +1,12 @@
 """Datum's CSV exporter."""
+from datetime import datetime, date, time
 import csv
+import decimal
+import io
+import json
+import os
 from pyodbc import ProgrammingError
+from . import memory
 
 _config = {}
 
@@ -21,8 +27,13 @@ def export_cursor_results(a_cursor):
     # Before trying anything, clear the value from the config dict.
     # Even if there's an error, we should go back to printing results.
     path = _config["csv_path"]
+    # With rotation on, the resultsets are written to numbered files that are
+    # listed in a manifest at the end
+    rotating = _config["rotate_rows"] or _config["rotate_bytes"]
+    chunks = [] if rotating else None
     try:
-        export_resultset(path, a_cursor)
+        memory.start()
+        memory.report(export_resultset(path, a_cursor, chunks=chunks))
     except ProgrammingError as e:
         if "Previous SQL was not a query." in str(e):
             pass
@@ -32,29 +43,277 @@ def export_cursor_results(a_cursor):
         try:
             # Newline to separate each file output
             print()
-            export_resultset(path, a_cursor, '\n\n')
+            memory.start()
+            memory.report(export_resultset(path, a_cursor, '\n\n',
+                                           chunks=chunks))
         except ProgrammingError as e:
             if "Previous SQL was not a query." in str(e):
                 continue
             else:
                 raise e
+    if chunks:
+        _write_manifest(path, chunks)
 
 
-def export_resultset(path, cursor, prefix=None):
+def export_resultset(path, cursor, prefix=None, header=True, progress=None,
+                     chunks=None):
     """Export the results of cursor (the "current" resultset).
 
     This function will attempt to keep the user updated as the export happens.
+    By default that means printing a "!" per batch, callers that export more
+    than one resultset at a time (see the partition module) can provide their
+    own progress function, which receives the count of rows written so far.
+    When chunks is a list, the output is split in numbered files following the
+    rules set with :rotate, and each file is added to chunks once closed.
+    Returns the number of rows written.
     """
     batch_size = 100000
-    print('Writing resultset, one ! per', batch_size, 'rows:')
-    with open(path, 'a', encoding='utf-8', newline='') as outputfile:
-        if prefix:
-            outputfile.write(prefix)
-        writer = csv.writer(outputfile)
-        # column headers are written even if no rows are returned
-        writer.writerow([column[0] for column in cursor.description])
+    if not progress:
+        print('Writing resultset, one ! per', batch_size, 'rows:')
+        progress = _print_tick
+    description = cursor.description
+    if chunks is None:
+        output = _FileOutput(path, description, prefix, header)
+    else:
+        output = _ChunkedOutput(path, description, chunks,
+                                _config["rotate_rows"],
+                                _config["rotate_bytes"])
+    rows_written = 0
+    with output:
         rows = cursor.fetchmany(batch_size)
         while rows:
-            writer.writerows(rows)
-            print("!", end="", flush=True)
+            memory.phase("fetch")
+            output.write_rows(rows)
+            memory.phase("write")
+            rows_written += len(rows)
+            progress(rows_written)
+            if memory.over_limit():
+                print("\nWARNING: memory ceiling reached after ",
+                      rows_written, " rows, export stopped.", sep="")
+                break
             rows = cursor.fetchmany(batch_size)
+    return rows_written
+
+
+def _print_tick(rows_written):
+    print("!", end="", flush=True)
+
+
+def _write_manifest(path, chunks):
+    """Write a JSON file that lists the files of a rotated export."""
+    base, _ = os.path.splitext(path)
+    manifest_path = base + ".manifest.json"
+    manifest = {"files": chunks,
+                "rows": sum(chunk["rows"] for chunk in chunks),
+                "bytes": sum(chunk["bytes"] for chunk in chunks)}
+    with open(manifest_path, 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    print('Manifest "', manifest_path, '" lists ', len(chunks), ' files.',
+          sep="")
+
+
+def _open_csv(path, mode, description):
+    """Open path to write CSV, return the file and a writer for it.
+
+    Depending on the config, the writer is the standard csv.writer, or the
+    faster _FastWriter. Both have writerow (used for headers) and writerows.
+    """
+    global _config
+    if _config["csv_encoder"] == "fast":
+        outputfile = open(path, mode + 'b',
+                          buffering=_config["export_buffer_size"])
+        return outputfile, _FastWriter(outputfile, description)
+    outputfile = open(path, mode, encoding='utf-8', newline='')
+    return outputfile, csv.writer(outputfile)
+
+
+def _line_encoder(description):
+    """Return a function that encodes rows as a list of CSV lines in bytes.
+
+    Each line includes its terminator. The encoding is the same the writer
+    picked by _open_csv would produce.
+    """
+    global _config
+    if _config["csv_encoder"] == "fast":
+        return _FastWriter(None, description).encode_lines
+    return _standard_lines
+
+
+def _standard_lines(rows):
+    """Encode rows as CSV lines in bytes, one at a time with csv.writer."""
+    text = io.StringIO()
+    writer = csv.writer(text)
+    lines = []
+    for row in rows:
+        writer.writerow(row)
+        lines.append(text.getvalue().encode('utf-8'))
+        text.seek(0)
+        text.truncate()
+    return lines
+
+
+class _FastWriter:
+    """CSV writer that encodes whole batches of rows at once.
+
+    The output is the same as csv.writer with the default dialect, but the
+    encoding of each column is chosen up front from cursor.description.
+    Numbers and dates never need quotes, so they are converted as-is. Only
+    text (and unknown types) is checked for characters that need quoting.
+    Each batch is written with a single call to write().
+    """
+
+    # Types for which str() never produces a comma, quote or newline
+    _safe_types = (bool, int, float, decimal.Decimal, datetime, date, time)
+
+    def __init__(self, outputfile, description):
+        self._file = outputfile
+        self._encode_rows = _compile_encoder(
+            [column[1] in self._safe_types for column in description])
+        # csv.writer quotes a row with one empty field, to tell it apart from
+        # an empty line
+        self._single_column = len(description) == 1
+
+    def writerow(self, values):
+        self._write_lines([",".join(_encode_text(value) for value in values)])
+
+    def writerows(self, rows):
+        self._write_lines(self._encode_rows(rows))
+
+    def encode_lines(self, rows):
+        """Encode rows as a list of lines in bytes, with their terminator."""
+        return [(line + "\r\n").encode('utf-8')
+                for line in self._quote_empty(self._encode_rows(rows))]
+
+    def _write_lines(self, lines):
+        lines = self._quote_empty(lines)
+        lines.append("")
+        self._file.write("\r\n".join(lines).encode('utf-8'))
+
+    def _quote_empty(self, lines):
+        if self._single_column:
+            return [line or '""' for line in lines]
+        return lines
+
+
+def _compile_encoder(safe_columns):
+    """Build a function that encodes a list of rows as a list of CSV lines.
+
+    Calling a function for each value is what makes encoding slow in Python,
+    so this generates a list comprehension with a single f-string per row.
+    Values of the safe types go straight into the f-string (which is the same
+    as str() for them), text goes through _encode_text.
+    """
+    names = [f"v{index}" for index in range(len(safe_columns))]
+    fields = [f"{{'' if {name} is None else {name}}}" if safe
+              else f"{{_encode_text({name})}}"
+              for name, safe in zip(names, safe_columns)]
+    # The trailing comma makes unpacking work for single column rows, too
+    source = (f"def encode_rows(rows):\n"
+              f"    return [f\"{','.join(fields)}\" "
+              f"for {', '.join(names)}, in rows]\n")
+    namespace = {"_encode_text": _encode_text}
+    exec(source, namespace)
+    return namespace["encode_rows"]
+
+
+def _encode_text(value):
+    if value is None:
+        return ""
+    value = str(value)
+    if '"' in value:
+        return '"' + value.replace('"', '""') + '"'
+    if "," in value or "\n" in value or "\r" in value:
+        return '"' + value + '"'
+    return value
+
+
+class _FileOutput:
+    """Export target that writes everything to a single file."""
+
+    def __init__(self, path, description, prefix, header):
+        self._file, self._writer = _open_csv(path, 'a', description)
+        if prefix:
+            self._file.write(prefix if isinstance(self._file, io.TextIOBase)
+                             else prefix.encode('utf-8'))
+        # column headers are written even if no rows are returned
+        if header:
+            self._writer.writerow([column[0] for column in description])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._file.close()
+
+    def write_rows(self, rows):
+        self._writer.writerows(rows)
+
+
+class _ChunkedOutput:
+    """Export target that writes to numbered files: name.00001.csv, etc.
+
+    A new file is started when the current one reaches the max rows, or when
+    the next row wouldn't fit in the max bytes. Rows are encoded before
+    writing them, so the size of each one is known exactly. A row bigger than
+    the max bytes still gets a file of its own, since it can't be split.
+    Each file has its own header, and the previous contents are replaced.
+    """
+
+    def __init__(self, path, description, chunks, max_rows, max_bytes):
+        self._base, self._extension = os.path.splitext(path)
+        self._header = _standard_lines([[column[0]
+                                         for column in description]])[0]
+        self._encode = _line_encoder(description)
+        self._chunks = chunks
+        self._max_rows = max_rows
+        self._max_bytes = max_bytes
+        self._file = None
+        # Even with no rows, there's a file with the headers
+        self._rotate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._close()
+
+    def write_rows(self, rows):
+        lines = []
+        for line in self._encode(rows):
+            if self._rows and self._full(len(line)):
+                self._file.write(b"".join(lines))
+                lines = []
+                self._rotate()
+            lines.append(line)
+            self._rows += 1
+            self._bytes += len(line)
+        self._file.write(b"".join(lines))
+
+    def _full(self, line_size):
+        if self._max_rows and self._rows >= self._max_rows:
+            return True
+        return bool(self._max_bytes
+                    and self._bytes + line_size > self._max_bytes)
+
+    def _rotate(self):
+        global _config
+        self._close()
+        number = len(self._chunks) + 1
+        self._path = f"{self._base}.{number:05}{self._extension}"
+        self._file = open(self._path, 'wb',
+                          buffering=_config["export_buffer_size"])
+        self._file.write(self._header)
+        self._rows = 0
+        self._bytes = len(self._header)
+
+    def _close(self):
+        if not self._file:
+            return
+        self._file.close()
+        self._file = None
+        size = os.path.getsize(self._path)
+        self._chunks.append({"file": os.path.basename(self._path),
+                             "rows": self._rows,
+                             "bytes": size})
+        print('\nClosed "', self._path, '", ', self._rows, ' rows, ', size,
+              ' bytes.', sep="", flush=True)
@@ -0,0 +1,222 @@
+"""Fan-out: run the same query on a group of connections at once.
+
+Groups are declared in the configuration file, in sections named
+[fanout.<group>] with one connection string per target. The query runs on all
+the targets concurrently, and the results are combined in a single resultset
+with a leading "source" column, that goes to the printer or the exporter as
+usual. The columns are those returned by most of the targets, the rest are
+reported as errors.
+"""
+from . import connect
+from . import exporter
+from . import printer
+from . import streams
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+import time
+
+_config = {}
+
+# Rows travel from the targets to the printer in batches of this size. The
+# queue in between is bounded, so memory doesn't depend on the results size
+_batch_size = 1000
+
+_different_columns = "the query returned different columns than most targets"
+
+
+def initialize_module(config):
+    """Initialize this module with a reference to the global config."""
+    global _config
+    _config = config
+
+
+def run(group, query, params):
+    """Run query on all the targets of group, and print or export the results.
+
+    Errors in a target are reported at the end, and don't stop the others.
+    Returns the total of rows read from all the targets.
+    """
+    global _config
+    targets = _config["fanout_groups"][group]
+    workers = min(len(targets), _config["max_connections"])
+    messages = queue.Queue(maxsize=workers * 2)
+    stop = threading.Event()
+    layout_ready = threading.Event()
+    print('Running on ', len(targets), ' targets of "', group, '" using ',
+          workers, ' connections.', sep="")
+    start = time.perf_counter()
+    pool = ThreadPoolExecutor(max_workers=workers)
+    for name, conn_string in targets.items():
+        pool.submit(_run_target, name, conn_string, query, params, messages,
+                    stop, layout_ready)
+    results = _FanIn(targets, messages, workers)
+    try:
+        description = results.wait_for_description()
+        layout_ready.set()
+        if description:
+            stream = streams.RowStream(description, results.rows())
+            if _config["csv_path"]:
+                exporter.export_cursor_results(stream)
+            else:
+                printer.print_cursor_results(stream, pageable=False)
+    finally:
+        # The printer doesn't read all the rows (see :rows), and the user
+        # might have pressed Ctrl-C. Either way, let the targets know
+        stop.set()
+        layout_ready.set()
+        pool.shutdown(wait=True)
+    results.print_summary(group, time.perf_counter() - start)
+    return results.row_count()
+
+
+def _run_target(name, conn_string, query, params, messages, stop,
+                layout_ready):
+    """Run the query in a single target, and queue the results.
+
+    The rows are fetched once layout_ready is set, after the columns of the
+    combined resultset were picked.
+    """
+    if stop.is_set():
+        return
+    start = time.perf_counter()
+    try:
+        connection = connect.open_connection(conn_string)
+        try:
+            cursor = connection.cursor()
+            cursor.execute(query, params)
+            # No description means it wasn't a query (UPDATE, etc.)
+            if cursor.description:
+                _put(messages, stop, (name, "description",
+                                      cursor.description))
+                layout_ready.wait()
+                rows = cursor.fetchmany(_batch_size)
+                while rows and not stop.is_set():
+                    _put(messages, stop, (name, "rows", rows))
+                    rows = cursor.fetchmany(_batch_size)
+            rowcount = cursor.rowcount
+        finally:
+            connection.close()
+    except Exception as err:
+        _put(messages, stop, (name, "error", err))
+        return
+    _put(messages, stop, (name, "done",
+                          (time.perf_counter() - start, rowcount)))
+
+
+def _put(messages, stop, message):
+    """Queue a message, unless the results are not needed anymore."""
+    while not stop.is_set():
+        try:
+            messages.put(message, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+class _FanIn:
+    """Collect the messages sent by the targets.
+
+    The rows are passed along to the printer, everything else is recorded for
+    the summary.
+    """
+
+    def __init__(self, targets, messages, first_wave):
+        self._messages = messages
+        self._pending = len(targets)
+        self._first_wave = first_wave
+        # The descriptions of the first wave, until the layout is picked
+        self._descriptions = {}
+        self._description = None
+        self._rows = dict.fromkeys(targets, 0)
+        self._elapsed = {}
+        self._rowcounts = {}
+        self._errors = {}
+
+    def wait_for_description(self):
+        """Block until the first wave of targets return a resultset.
+
+        The first wave are as many targets as there are connections. They
+        wait for the layout to be picked before fetching rows, and targets
+        that fail or don't run a query make room for the next ones. The
+        columns most of them returned (by name) are the ones of the combined
+        resultset, and the targets with other columns are reported as errors.
+        Returns None if none of the targets ran a query.
+        """
+        while self._pending and (len(self._descriptions)
+                                 < min(self._first_wave, self._pending)):
+            self._handle(*self._messages.get())
+        layouts = Counter(_column_names(description)
+                          for description in self._descriptions.values())
+        if layouts:
+            # On a tie, the first one to arrive
+            majority = layouts.most_common(1)[0][0]
+            for name, description in self._descriptions.items():
+                if _column_names(description) != majority:
+                    # The rows will be discarded in rows()
+                    self._errors[name] = _different_columns
+                elif not self._description:
+                    self._description = ((streams.column("source"),)
+                                         + tuple(description))
+        self._descriptions = None
+        return self._description
+
+    def rows(self):
+        """Generate the rows of all targets, in the order they arrive."""
+        while self._pending:
+            name, kind, payload = self._messages.get()
+            if kind != "rows":
+                self._handle(name, kind, payload)
+            elif name not in self._errors:
+                self._rows[name] += len(payload)
+                for row in payload:
+                    yield (name, *row)
+
+    def row_count(self):
+        """Rows read from all the targets, or rows affected if no query."""
+        if self._description:
+            return sum(self._rows.values())
+        return sum(count for count in self._rowcounts.values() if count > 0)
+
+    def print_summary(self, group, elapsed):
+        """Print the counts and timings, and the error of each failed target.
+
+        Targets that didn't finish are those that weren't needed anymore.
+        """
+        succeeded = [name for name in self._elapsed
+                     if name not in self._errors]
+        print('\nFanout "', group, '": ', len(self._rows), ' targets, ',
+              len(succeeded), ' OK, ', len(self._errors), ' failed in ',
+              f"{elapsed:.2f}s", sep="", end="")
+        if self._elapsed:
+            slowest = max(self._elapsed, key=self._elapsed.get)
+            print(' (slowest ', slowest, ' ', f"{self._elapsed[slowest]:.2f}s",
+                  ')', sep="")
+        else:
+            print()
+        for name, message in self._errors.items():
+            print(name, ": ERROR ", message, sep="")
+
+    def _handle(self, name, kind, payload):
+        if kind == "description":
+            if self._descriptions is not None:
+                # Still waiting for the first wave
+                self._descriptions[name] = payload
+            elif (_column_names(payload)
+                  != _column_names(self._description[1:])):
+                # The rows will be discarded in rows()
+                self._errors[name] = _different_columns
+        elif kind == "error":
+            self._pending -= 1
+            message = (payload.args[1] if len(payload.args) > 1
+                       else str(payload))
+            # Keep it to one line, for the same reason the main loop does
+            self._errors[name] = message.split("\n")[0]
+        elif kind == "done":
+            self._pending -= 1
+            self._elapsed[name], self._rowcounts[name] = payload
+
+
+def _column_names(description):
+    return tuple(column[0] for column in description)
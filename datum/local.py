@@ -0,0 +1,183 @@
+"""Local SQLite database, to keep a copy of query results around.
+
+:materialize streams the results of a query into a table of this database,
+and :local sends queries here instead of the server, so follow up queries on
+the same data don't need a round trip.
+"""
+from . import connect
+from . import environment
+from datetime import datetime, date, time
+from pyodbc import ProgrammingError
+from time import perf_counter
+import decimal
+import sqlite3
+
+_config = {}
+_connection = None
+
+# How many rows to fetch and insert at a time
+_batch_size = 10000
+
+# SQLite has very few types, and the sqlite3 module can't bind some of the
+# Python types pyodbc returns. The descriptions have the Python type of each
+# column, which is mapped to a column type and (when needed) a conversion
+_column_types = {bool: ("INTEGER", None),
+                 int: ("INTEGER", None),
+                 float: ("REAL", None),
+                 decimal.Decimal: ("NUMERIC", str),
+                 str: ("TEXT", None),
+                 bytes: ("BLOB", None),
+                 bytearray: ("BLOB", None),
+                 datetime: ("TEXT", lambda value: value.isoformat(sep=" ")),
+                 date: ("TEXT", date.isoformat),
+                 time: ("TEXT", time.isoformat)}
+
+
+def initialize_module(config):
+    """Initialize this module with a reference to the global config."""
+    global _config
+    _config = config
+
+
+def get_connection():
+    """Return the connection to the local database, opening it if needed."""
+    global _connection
+    if not _connection:
+        # isolation_level=None is autocommit, same as the ODBC connections
+        _connection = sqlite3.connect(get_path(), isolation_level=None)
+    return _connection
+
+
+def get_path():
+    """Path to the local database file.
+
+    It can be set in the config file, or else it is kept in datum's cache dir.
+    """
+    global _config
+    if _config["local_database"]:
+        return _config["local_database"]
+    return environment.get_cache_path("local.sqlite3")
+
+
+def cursor():
+    """Return a new cursor in the local database, usable by the printer."""
+    return _LocalCursor(get_connection().cursor())
+
+
+def table_names():
+    """List the tables in the local database."""
+    local_cursor = get_connection().execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")
+    return [row[0] for row in local_cursor.fetchall()]
+
+
+def materialize(query, params, table, indexes):
+    """Run query on the server, and copy its results into table.
+
+    The table is replaced if it exists. indexes is a list of column lists,
+    an index is created for each of them after loading the rows.
+    Returns the count of rows copied.
+    """
+    start = perf_counter()
+    remote = connect.get_connection().cursor()
+    remote.execute(query, params)
+    if not remote.description:
+        print("The query didn't return any results, nothing to materialize.")
+        return remote.rowcount
+    names = _column_names(remote.description)
+    types, converters = zip(*(_column_types.get(column[1], ("TEXT", str))
+                              for column in remote.description))
+    columns = ", ".join(f"{_quote(name)} {column_type}"
+                        for name, column_type in zip(names, types))
+    insert = (f"INSERT INTO {_quote(table)} VALUES "
+              f"({', '.join('?' * len(names))})")
+    # Only convert the values of the columns that need it
+    converted = [(index, converter) for index, converter
+                 in enumerate(converters) if converter]
+    print('Copying rows to local table "', table, '", one ! per ',
+          _batch_size, ' rows:', sep="")
+    local = get_connection()
+    row_count = 0
+    local.execute("BEGIN")
+    try:
+        local.execute(f"DROP TABLE IF EXISTS {_quote(table)}")
+        local.execute(f"CREATE TABLE {_quote(table)} ({columns})")
+        rows = remote.fetchmany(_batch_size)
+        while rows:
+            if converted:
+                rows = [_convert(row, converted) for row in rows]
+            local.executemany(insert, rows)
+            row_count += len(rows)
+            print("!", end="", flush=True)
+            rows = remote.fetchmany(_batch_size)
+        for number, index_columns in enumerate(indexes, 1):
+            local.execute(f"CREATE INDEX {_quote(f'{table}_{number}')} ON "
+                          f"{_quote(table)} "
+                          f"({', '.join(map(_quote, index_columns))})")
+        local.execute("COMMIT")
+    except Exception:
+        local.execute("ROLLBACK")
+        raise
+    elapsed = perf_counter() - start
+    print('\nMaterialized ', row_count, ' rows in local table "', table,
+          '" in ', f"{elapsed:.2f}s", sep="")
+    return row_count
+
+
+def _convert(row, converted):
+    values = list(row)
+    for index, converter in converted:
+        if values[index] is not None:
+            values[index] = converter(values[index])
+    return values
+
+
+def _column_names(description):
+    """Column names for the local table, unique and never empty.
+
+    Things like "SELECT COUNT(*)" or joins with columns of the same name
+    would be a problem otherwise.
+    """
+    names = []
+    for position, column in enumerate(description, 1):
+        name = column[0] or f"column{position}"
+        unique_name = name
+        suffix = 1
+        while unique_name.lower() in (existing.lower() for existing in names):
+            suffix += 1
+            unique_name = f"{name}_{suffix}"
+        names.append(unique_name)
+    return names
+
+
+def _quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+class _LocalCursor:
+    """Wrap a sqlite3 cursor so it behaves like a pyodbc cursor.
+
+    The printer and the exporter rely on pyodbc raising an error for
+    statements that don't return results, and on nextset(). Everything else
+    works the same in both.
+    """
+
+    def __init__(self, sqlite_cursor):
+        self._cursor = sqlite_cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    @property
+    def description(self):
+        if self._cursor.description is None:
+            raise ProgrammingError("No results.  Previous SQL was not a "
+                                   "query.")
+        return self._cursor.description
+
+    def execute(self, query, params=()):
+        self._cursor.execute(query, params)
+        return self
+
+    def nextset(self):
+        return False
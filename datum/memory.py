@@ -0,0 +1,186 @@
+"""Memory accounting for printing and exporting resultsets.
+
+This is opt-in (see :mem) since tracing allocations slows Python down. When
+enabled, tracemalloc measures the peak of each phase of the work (fetching,
+formatting, etc.) and the process' RSS is sampled along the way.
+The memory ceiling works without tracing, it only looks at the current RSS,
+which is available on Linux and Windows.
+"""
+import os
+import sys
+import tracemalloc
+try:
+    import resource
+except ImportError:
+    # Not available in Windows
+    resource = None
+
+_config = {}
+
+# tracemalloc.reset_peak is new in Python 3.9, before that the phases can only
+# report what they left allocated
+_can_reset_peak = hasattr(tracemalloc, "reset_peak")
+
+# Measurements for the resultset in progress
+_baseline = 0
+_phase_start = 0
+_peak = 0
+_phases = {}
+_rss_peak = 0
+
+
+def initialize_module(config):
+    """Initialize this module with a reference to the global config."""
+    global _config
+    _config = config
+    if _config["memory_tracking"]:
+        tracemalloc.start()
+
+
+def set_tracking(enabled):
+    """Start or stop tracing allocations."""
+    global _config
+    _config["memory_tracking"] = enabled
+    if enabled and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif not enabled and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def start():
+    """Start measuring a new resultset."""
+    global _baseline, _phase_start, _peak, _phases, _rss_peak
+    if not tracemalloc.is_tracing():
+        return
+    if _can_reset_peak:
+        tracemalloc.reset_peak()
+    else:
+        # Forgetting the traces is the only other way to reset the peak, the
+        # memory already in use stops counting
+        tracemalloc.clear_traces()
+    _baseline, _ = tracemalloc.get_traced_memory()
+    _phase_start = _baseline
+    _peak = 0
+    _phases = {}
+    _rss_peak = _rss_sample() or 0
+
+
+def phase(name):
+    """Attribute the memory allocated since the last call to the phase name.
+
+    What counts is the peak during the phase, over what was already in use
+    when it started. A phase can be recorded many times (once per batch, for
+    example), the highest value is kept.
+    """
+    global _phase_start, _peak, _rss_peak
+    if not tracemalloc.is_tracing():
+        return
+    current, peak = tracemalloc.get_traced_memory()
+    _peak = max(_peak, peak - _baseline)
+    if not _can_reset_peak:
+        # The peak is the one since start()
+        peak = current
+    _phases[name] = max(_phases.get(name, 0), peak - _phase_start)
+    _phase_start = current
+    if _can_reset_peak:
+        tracemalloc.reset_peak()
+    _rss_peak = max(_rss_peak, _rss_sample() or 0)
+
+
+def report(row_count):
+    """Print the measurements for the resultset, if tracking is enabled.
+
+    Call it after the function that handled the resultset returned, so that
+    "retained" is what's left after its local variables are gone.
+    """
+    if not tracemalloc.is_tracing() or not _phases:
+        return
+    current, _ = tracemalloc.get_traced_memory()
+    dominant = max(_phases, key=_phases.get)
+    print("\nMemory: peak ", format_size(_peak),
+          ", retained ", format_size(max(current - _baseline, 0)),
+          ", ", f"{_peak // row_count:,}" if row_count else "-", " bytes/row",
+          ", RSS ", format_size(_rss_peak), sep="")
+    print("Phases: ", ", ".join(f"{name} {format_size(size)}"
+                                for name, size in _phases.items()),
+          " (", dominant, " dominated)", sep="")
+
+
+def over_limit():
+    """True if there's a memory ceiling, and the process is over it.
+
+    Where the current RSS isn't available the ceiling doesn't apply.
+    """
+    global _config
+    limit = _config["memory_limit"]
+    if not limit:
+        return False
+    current = rss()
+    return current is not None and current > limit
+
+
+def rss():
+    """Current resident memory of the process in bytes, or None if unknown.
+
+    Linux and Windows report it. Elsewhere (macOS, the BSDs) only the peak is
+    available, and since it never goes down, it's no good for the ceiling.
+    """
+    if sys.platform == "win32":
+        return _windows_rss()
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _rss_sample():
+    """RSS for the report, the peak so far is better than nothing."""
+    current = rss()
+    if current is not None or not resource:
+        return current
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, others (the BSDs) use KB like Linux
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _windows_rss():
+    """Working set of the process, via GetProcessMemoryInfo."""
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [("cb", wintypes.DWORD),
+                    ("PageFaultCount", wintypes.DWORD),
+                    ("PeakWorkingSetSize", ctypes.c_size_t),
+                    ("WorkingSetSize", ctypes.c_size_t),
+                    ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                    ("PagefileUsage", ctypes.c_size_t),
+                    ("PeakPagefileUsage", ctypes.c_size_t)]
+
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    try:
+        kernel32 = ctypes.windll.kernel32
+        kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+        if not kernel32.K32GetProcessMemoryInfo(
+                kernel32.GetCurrentProcess(), ctypes.byref(counters),
+                counters.cb):
+            return None
+    except (AttributeError, OSError):
+        return None
+    return counters.WorkingSetSize
+
+
+def format_size(size):
+    """Format a size in bytes for printing."""
+    if size is None:
+        return "(unknown)"
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
@@ -0,0 +1,200 @@
+"""Partitioned export: run a query in slices, over several connections.
+
+A single cursor means a single server session doing all the work. For big
+extracts the query is split by a key column, and each partition is exported
+by its own connection, in a pool of threads. pyodbc releases the GIL while
+waiting on the driver, so threads are good enough here.
+"""
+from . import connect
+from . import exporter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import os
+import shutil
+import threading
+import time
+
+_config = {}
+
+# All the partitions report progress at the same time, this keeps the lines
+# from getting mixed up
+_print_lock = threading.Lock()
+
+
+def initialize_module(config):
+    """Initialize this module with a reference to the global config."""
+    global _config
+    _config = config
+
+
+def export_partitioned(path, query, params):
+    """Export the results of query to path, one connection per partition.
+
+    The partitioning settings come from the :partition command. Each partition
+    is written to its own file next to path, unless "merge" was requested, in
+    which case they are concatenated (in key order) into path at the end.
+    Returns the total rows exported.
+    """
+    global _config
+    settings = _config["partition"]
+    column = settings["column"]
+    # The query is going to be wrapped in a subquery, a terminator would
+    # break it. ";;" is what the user typed to send the query, after all
+    query = query.strip().rstrip(";")
+    if settings["mode"] == "range":
+        partitions = _range_partitions(query, params, column,
+                                       settings["count"])
+    else:
+        partitions = _modulo_partitions(query, params, column,
+                                        settings["count"])
+    base, extension = os.path.splitext(path)
+    merge = settings["merge"]
+    part_paths = [f"{base}.part{number:02}{extension}"
+                  for number in range(1, len(partitions) + 1)]
+    # Exports append to their target, but the partition files should only
+    # contain the output of this run
+    for part_path in part_paths:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    workers = min(len(partitions), _config["max_connections"])
+    print('Exporting', len(partitions), 'partitions of', column, 'using',
+          workers, 'connections:')
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for number, ((part_query, part_params), part_path) in enumerate(
+                zip(partitions, part_paths), 1):
+            # When merging, only the first file gets the column headers
+            futures.append(pool.submit(_export_partition, number, part_query,
+                                       part_params, part_path,
+                                       number == 1 or not merge))
+    errors = []
+    total_rows = 0
+    for number, future in enumerate(futures, 1):
+        try:
+            total_rows += future.result()
+        except Exception as err:
+            print(f"Partition {number:02} failed:", err)
+            errors.append(err)
+    if errors:
+        # The loop will print the details of the first one, the rest were
+        # listed above
+        raise errors[0]
+    elapsed = time.perf_counter() - start
+    if merge:
+        _merge_files(part_paths, path)
+        print('Merged ', len(part_paths), ' partitions into "', path, '"',
+              sep="")
+    print("Exported", total_rows, "rows in", f"{elapsed:.2f}s",
+          f"({_rate(total_rows, elapsed)} rows/s)")
+    return total_rows
+
+
+def _export_partition(number, query, params, path, header):
+    """Run a single partition on a brand new connection."""
+    start = time.perf_counter()
+
+    def progress(rows_written):
+        with _print_lock:
+            print(f"[{number:02}]", rows_written, "rows", flush=True)
+
+    connection = connect.open_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(query, params)
+        rows = exporter.export_resultset(path, cursor, header=header,
+                                         progress=progress)
+    finally:
+        connection.close()
+    elapsed = time.perf_counter() - start
+    with _print_lock:
+        print(f"[{number:02}] done,", rows, "rows in", f"{elapsed:.2f}s",
+              f"({_rate(rows, elapsed)} rows/s)", flush=True)
+    return rows
+
+
+def _range_partitions(query, params, column, count):
+    """Split the query in count contiguous ranges of column.
+
+    The boundaries are calculated from MIN and MAX of the key, so this works
+    with numbers and dates. Each partition is sorted by the key, which is what
+    allows merging the files in order later.
+    Returns a list of (query, params) tuples.
+    """
+    cursor = connect.get_connection().cursor()
+    cursor.execute(f"SELECT MIN({column}), MAX({column}) "
+                   f"FROM (\n{query}\n) datum_bounds", params)
+    low, high = cursor.fetchone()
+    cursor.close()
+    if low is None:
+        # No rows, or all keys are NULL. Nothing to split
+        return [(query, params)]
+    try:
+        bounds = [_boundary(low, high, index, count)
+                  for index in range(count)] + [high]
+    except TypeError:
+        raise ValueError(f"Can't calculate ranges for {column}, range "
+                         "partitioning needs a numeric or date column.")
+    partitions = []
+    for index in range(count):
+        # The last range includes the upper bound, and NULL keys go in the
+        # first partition. Engines don't agree on where NULLs sort (Oracle
+        # and PostgreSQL put them last), so for merged files to be in key
+        # order they are sorted first explicitly
+        operator = "<=" if index == count - 1 else "<"
+        nulls = f" OR {column} IS NULL" if index == 0 else ""
+        order = (f"CASE WHEN {column} IS NULL THEN 0 ELSE 1 END, {column}"
+                 if index == 0 else column)
+        part_query = (f"SELECT * FROM (\n{query}\n) datum_part WHERE "
+                      f"({column} >= ? AND {column} {operator} ?){nulls} "
+                      f"ORDER BY {order}")
+        partitions.append((part_query,
+                           list(params) + [bounds[index], bounds[index + 1]]))
+    return partitions
+
+
+def _modulo_partitions(query, params, column, count):
+    """Split the query in count partitions, using the modulo of the key.
+
+    Returns a list of (query, params) tuples.
+    """
+    # Oracle doesn't have the % operator, MOD() is the only option there.
+    # MSSQL is the opposite, it only has %
+    if "oracle" in connect.get_dbms_name().lower():
+        modulo = f"MOD({column}, {count})"
+    else:
+        modulo = f"{column} % {count}"
+    partitions = []
+    for index in range(count):
+        nulls = f" OR {column} IS NULL" if index == 0 else ""
+        part_query = (f"SELECT * FROM (\n{query}\n) datum_part "
+                      f"WHERE ABS({modulo}) = {index}{nulls}")
+        partitions.append((part_query, params))
+    return partitions
+
+
+def _boundary(low, high, index, count):
+    """Calculate the lower boundary of a range partition."""
+    span = high - low
+    # Integer keys and dates should stay that way, both ints and timedeltas
+    # support floor division. Decimals and floats are fine with regular
+    # division
+    if isinstance(span, (int, timedelta)):
+        return low + span * index // count
+    return low + span * index / count
+
+
+def _merge_files(part_paths, path):
+    """Append each partition file to the final output, then remove it."""
+    with open(path, 'ab') as output:
+        for part_path in part_paths:
+            with open(part_path, 'rb') as part:
+                shutil.copyfileobj(part, output)
+            os.remove(part_path)
+
+
+def _rate(rows, elapsed):
+    """Rows per second, formatted for printing."""
+    if not elapsed:
+        return "-"
+    return f"{rows / elapsed:,.0f}"
@@ -2,12 +2,16 @@
 from collections import defaultdict
 from datetime import datetime, date, time
 from pyodbc import ProgrammingError
+from . import memory
 import decimal
 import math
 import operator as op
 
 _config = {}
 
+# The cursor of a resultset that wasn't printed in full, for :more and :rest
+_pending = None
+
 
 def initialize_module(config):
     """Initialize this module with a reference to the global config."""
@@ -17,59 +21,65 @@ def initialize_module(config):
     _config = config
 
 
-def print_cursor_results(a_cursor):
+def print_cursor_results(a_cursor, pageable=True):
     """Print the current cursor resultset and (try to) move to the next one.
 
     Most queries have a single resulset, but stored procs for example use the
     extra logic.
+    If a resultset isn't printed in full, and pageable is True, the cursor is
+    left pending for :more and :rest, and the following resultsets wait too.
     Note that the actual printing of output happens in print_resultset().
     """
-    try:
-        print_resultset(a_cursor)
-    except ProgrammingError as e:
-        if "Previous SQL was not a query." in str(e):
-            pass
-        else:
-            raise e
-    while a_cursor.nextset():
+    while True:
         try:
-            print_resultset(a_cursor)
+            memory.start()
+            memory.report(print_resultset(a_cursor, pageable=pageable))
+            if _pending:
+                return
         except ProgrammingError as e:
-            if "Previous SQL was not a query." in str(e):
-                continue
-            else:
+            if "Previous SQL was not a query." not in str(e):
                 raise e
+        if not a_cursor.nextset():
+            return
 
 
-def print_resultset(a_cursor):
+def print_resultset(a_cursor, rows_to_print=None, pageable=False):
     """Print the results of cursor (the "current" resultset).
 
     This function is a performance disgrace waiting to happen. It might (when
     :rows 0) fetch ALL THE ROWS of the cursor, and then there is always a full
     iteration to determine the printing width.
     I would argue though, that no one would use datum to print millions of
-    rows at a time.
+    rows at a time. And if someone does, there's :mem to set a ceiling.
+    rows_to_print defaults to the :rows setting, and 0 means all of them.
+    When pageable is True and there might be rows left, the cursor is kept
+    for :more and :rest.
+    Returns the number of rows printed.
     """
-    global _config
-    rows_to_print = _config["rows_to_print"]
-    if rows_to_print:
+    global _config, _pending
+    if rows_to_print is None:
+        rows_to_print = _config["rows_to_print"]
+    fetched_all = True
+    if _config["memory_limit"]:
+        odbc_rows, fetched_all = _fetch_with_limit(a_cursor, rows_to_print)
+    elif rows_to_print:
         odbc_rows = a_cursor.fetchmany(rows_to_print)
     else:
         odbc_rows = a_cursor.fetchall()
+    memory.phase("fetch")
 
     rowcount = a_cursor.rowcount
     # If there are no rows, we still print the column names, as this is useful
     # when exploring how many columns there are and their names in a new DB
-    column_names = [text_formatter(column[0]) for column in
-                    a_cursor.description]
-    format_str, print_ready = format_rows(column_names, odbc_rows)
-    print()  # blank line
-    print("\n".join(format_str.format(*row) for row in print_ready))
+    column_names = [column[0] for column in a_cursor.description]
+    widths = print_table(column_names, odbc_rows)
     # Try to determine if all rows returned were printed
     # MS SQL Server doesn't report the total rows SELECTed,
     # but for example MySql does.
     printed_rows = len(odbc_rows)
-    if printed_rows < rows_to_print or rows_to_print == 0:
+    complete = fetched_all and (printed_rows < rows_to_print
+                                or rows_to_print == 0)
+    if complete:
         # We printed everything via :rows 0, or less than the max to print
         # in which case we can deduct there were no more rows
         rowcount = printed_rows
@@ -78,6 +88,130 @@ def print_resultset(a_cursor):
         rowcount = "(unknown)"
     # We tried our best! report the numbers
     print("\nRows printed: ", printed_rows, "/", rowcount, sep="")
+    if pageable and not complete and rowcount != printed_rows:
+        _pending = {"cursor": a_cursor, "column_names": column_names,
+                    "widths": widths, "printed_rows": printed_rows}
+        print("More rows pending, use :more [n] or :rest to see them.")
+    return printed_rows
+
+
+def print_more(count):
+    """Print the next count rows of the pending resultset.
+
+    The columns are at least as wide as in the previous pages. Once the
+    resultset is over, the following resultsets (if any) are printed as usual.
+    """
+    global _pending
+    if not _pending:
+        print("There are no pending results.")
+        return
+    a_cursor = _pending["cursor"]
+    rows = a_cursor.fetchmany(count)
+    if rows:
+        _pending["widths"] = print_table(_pending["column_names"], rows,
+                                         _pending["widths"])
+    _pending["printed_rows"] += len(rows)
+    print("\nRows printed: ", len(rows), " (", _pending["printed_rows"],
+          " so far)", sep="")
+    if len(rows) < count:
+        _pending = None
+        print("End of the resultset.")
+        if a_cursor.nextset():
+            print_cursor_results(a_cursor)
+    else:
+        print("Use :more [n] or :rest to continue.")
+
+
+def print_rest():
+    """Print all the remaining rows of the pending resultset, and the next.
+
+    The rows are fetched and printed in batches, so memory use doesn't
+    depend on how many rows are left.
+    """
+    global _config, _pending
+    if not _pending:
+        print("There are no pending results.")
+        return
+    pending = _pending
+    _pending = None
+    a_cursor = pending["cursor"]
+    count = max(_config["rows_to_print"], 10000)
+    widths = pending["widths"]
+    printed_rows = 0
+    rows = a_cursor.fetchmany(count)
+    while rows:
+        widths = print_table(pending["column_names"], rows, widths)
+        printed_rows += len(rows)
+        rows = a_cursor.fetchmany(count)
+    print("\nRows printed: ", printed_rows, " (",
+          pending["printed_rows"] + printed_rows, " in total)", sep="")
+    if a_cursor.nextset():
+        print_cursor_results(a_cursor)
+
+
+def take_pending():
+    """Return the pending cursor, if any, and forget about it.
+
+    From then on the caller is responsible for the rest of the results.
+    """
+    global _pending
+    if not _pending:
+        return None
+    a_cursor = _pending["cursor"]
+    _pending = None
+    return a_cursor
+
+
+def release_pending():
+    """Discard the pending results, if any.
+
+    Called before running a new query, so the connection is free for it.
+    """
+    a_cursor = take_pending()
+    if a_cursor:
+        # The cursor might be reused (see connect.get_cursor), so don't close
+        # it, moving past the remaining resultsets frees the connection too
+        while a_cursor.nextset():
+            pass
+
+
+def _fetch_with_limit(a_cursor, rows_to_print):
+    """Fetch the rows to print in batches, checking the memory ceiling.
+
+    If the ceiling is reached, stop fetching and keep what we have so far.
+    Returns the rows, and False if the fetch was stopped.
+    """
+    batch_size = 10000
+    odbc_rows = []
+    while not rows_to_print or len(odbc_rows) < rows_to_print:
+        if rows_to_print:
+            batch_size = min(batch_size, rows_to_print - len(odbc_rows))
+        batch = a_cursor.fetchmany(batch_size)
+        if not batch:
+            break
+        odbc_rows.extend(batch)
+        if memory.over_limit():
+            print("\nWARNING: memory ceiling reached after ", len(odbc_rows),
+                  " rows, the rest of the resultset was not fetched.", sep="")
+            return odbc_rows, False
+    return odbc_rows, True
+
+
+def print_table(column_names, rows, min_widths=None):
+    """Print rows with the same format used for resultsets.
+
+    Useful to show the output of commands as a table. Columns are at least as
+    wide as min_widths, if provided, which helps pages of the same results
+    line up. Returns the width of each column.
+    """
+    column_names = [text_formatter(name) for name in column_names]
+    format_str, print_ready = format_rows(column_names, rows, min_widths)
+    memory.phase("format")
+    output = "\n".join(format_str.format(*row) for row in print_ready)
+    memory.phase("join")
+    print()  # blank line
+    print(output)
+    return [len(dashes) for dashes in print_ready[1]]
 
 
 def text_formatter(value):
@@ -101,7 +235,7 @@ def text_formatter(value):
     return value
 
 
-def format_rows(column_names, raw_rows):
+def format_rows(column_names, raw_rows, min_widths=None):
     """Go over all the rows in the results and format them for printing.
 
     This depends on both the data type and the configuration of this session.
@@ -159,6 +293,8 @@ def format_rows(column_names, raw_rows):
 
     for index, col_name in enumerate(column_names):
         column_widths[index] = max((column_widths[index], len(col_name)))
+    for index, width in enumerate(min_widths or ()):
+        column_widths[index] = max(column_widths[index], width)
 
     format_str = "|".join(["{{{ndx}:{len}}}".format(ndx=ndx, len=len)
                            for ndx, len in column_widths.items()])
@@ -0,0 +1,191 @@
+"""Profile the columns of a query's results in a single pass.
+
+For each column: NULLs, min/max, average length, distinct values and the most
+frequent values. Rows are fetched in batches and dropped after updating the
+stats, so memory use doesn't depend on the size of the results. The distinct
+count is a HyperLogLog estimate, and the frequent values come from the
+Misra-Gries algorithm, both use a fixed amount of memory per column.
+"""
+from . import connect
+from . import local
+from . import printer
+from pyodbc import ProgrammingError
+import math
+import time
+
+_config = {}
+
+_batch_size = 10000
+
+# 2^12 registers per column, the estimates are within ~1.6% of the real count
+_precision = 12
+_registers = 1 << _precision
+_mask64 = (1 << 64) - 1
+
+
+def initialize_module(config):
+    """Initialize this module with a reference to the global config."""
+    global _config
+    _config = config
+
+
+def run(query, params, top):
+    """Execute query and print a profile of each resultset.
+
+    top is how many of the most frequent values to show per column.
+    Returns the total of rows profiled.
+    """
+    global _config
+    if _config["local"]:
+        cursor = local.cursor()
+    else:
+        cursor = connect.get_cursor(query)
+    start = time.perf_counter()
+    cursor.execute(query, params)
+    total_rows = 0
+    while True:
+        try:
+            # No description means it wasn't a query (UPDATE, etc.)
+            if cursor.description:
+                total_rows += _profile_resultset(cursor, top, start)
+        except ProgrammingError as e:
+            if "Previous SQL was not a query." not in str(e):
+                raise e
+        if not cursor.nextset():
+            return total_rows
+        start = time.perf_counter()
+
+
+def _profile_resultset(cursor, top, start):
+    """Profile the current resultset of cursor, return the row count."""
+    columns = [_ColumnProfile(column[1], top)
+               for column in cursor.description]
+    row_count = 0
+    rows = cursor.fetchmany(_batch_size)
+    while rows:
+        row_count += len(rows)
+        for index, column in enumerate(columns):
+            column.add([row[index] for row in rows])
+        rows = cursor.fetchmany(_batch_size)
+    elapsed = time.perf_counter() - start
+    printer.print_table(
+        ["column", "type", "nulls", "distinct", "min", "max", "avg len",
+         "top values"],
+        [(description[0], *column.summary())
+         for description, column in zip(cursor.description, columns)])
+    print("\nProfiled ", row_count, " rows in ", f"{elapsed:.2f}s", sep="")
+    return row_count
+
+
+class _ColumnProfile:
+    """The stats for a column, updated a batch of values at a time."""
+
+    def __init__(self, type_code, top):
+        self.type_name = getattr(type_code, "__name__", None)
+        self.top = top
+        self.nulls = 0
+        self.values = 0
+        self.minimum = None
+        self.maximum = None
+        # Once values that can't be compared (or measured) show up, give up
+        self.comparable = True
+        self.measurable = True
+        self.total_length = 0
+        self.registers = bytearray(_registers)
+        # Misra-Gries keeps some extra counters, the more it has the better
+        # the counts of the top values
+        self.counters = {}
+        self.max_counters = max(top * 10, 100)
+
+    def add(self, batch):
+        values = [value for value in batch if value is not None]
+        self.nulls += len(batch) - len(values)
+        if not values:
+            return
+        self.values += len(values)
+        if self.type_name is None:
+            # The driver didn't say, use the first value
+            self.type_name = type(values[0]).__name__
+        if self.comparable:
+            try:
+                low, high = min(values), max(values)
+                if self.minimum is not None:
+                    low = min(low, self.minimum)
+                    high = max(high, self.maximum)
+                self.minimum, self.maximum = low, high
+            except TypeError:
+                self.comparable = False
+                self.minimum = self.maximum = None
+        if self.measurable:
+            try:
+                self.total_length += sum(map(len, values))
+            except TypeError:
+                # Numbers, dates, etc.
+                self.measurable = False
+        counts = {}
+        for value in values:
+            counts[value] = counts.get(value, 0) + 1
+        for value in counts:
+            self._add_to_sketch(value)
+        self._add_to_counters(counts)
+
+    def summary(self):
+        """Return the values for the profile table."""
+        average_length = (f"{self.total_length / self.values:.1f}"
+                          if self.measurable and self.values else "-")
+        frequent = sorted(self.counters.items(), key=lambda item: -item[1])
+        top_values = ", ".join(f"{printer.text_formatter(value)} ({count})"
+                               for value, count in frequent[:self.top])
+        return (self.type_name or "-", self.nulls,
+                f"~{self._estimate_distinct()}",
+                self.minimum if self.comparable else "-",
+                self.maximum if self.comparable else "-",
+                average_length, top_values)
+
+    def _add_to_sketch(self, value):
+        hashed = _mix(hash(value))
+        register = hashed >> (64 - _precision)
+        rest = hashed & ((1 << (64 - _precision)) - 1)
+        # Position of the first 1 bit, counting from the left
+        rank = 64 - _precision - rest.bit_length() + 1
+        if rank > self.registers[register]:
+            self.registers[register] = rank
+
+    def _estimate_distinct(self):
+        alpha = 0.7213 / (1 + 1.079 / _registers)
+        estimate = alpha * _registers * _registers / sum(
+            2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * _registers and zeros:
+            # Few values, linear counting is more precise
+            estimate = _registers * math.log(_registers / zeros)
+        return round(estimate)
+
+    def _add_to_counters(self, counts):
+        """Add the counts of a batch to the Misra-Gries counters.
+
+        When there are too many counters, all of them go down by the count of
+        the first one that doesn't fit, and those that reach 0 are dropped.
+        Counts are underestimated, by at most rows / max_counters.
+        """
+        counters = self.counters
+        for value, count in counts.items():
+            counters[value] = counters.get(value, 0) + count
+        if len(counters) <= self.max_counters:
+            return
+        threshold = sorted(counters.values(),
+                           reverse=True)[self.max_counters]
+        self.counters = {value: count - threshold
+                         for value, count in counters.items()
+                         if count > threshold}
+
+
+def _mix(number):
+    """splitmix64 finalizer, spreads the bits of hash() for the sketch.
+
+    Python's hash of an int is the int itself, which is far from random.
+    """
+    number = (number + 0x9E3779B97F4A7C15) & _mask64
+    number = ((number ^ (number >> 30)) * 0xBF58476D1CE4E5B9) & _mask64
+    number = ((number ^ (number >> 27)) * 0x94D049BB133111EB) & _mask64
+    return number ^ (number >> 31)
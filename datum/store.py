@@ -0,0 +1,437 @@
+"""Keep the last resultset in memory, to sort, filter and group it locally.
+
+Rows are stored by column: integers and floats in typed arrays (with a mask
+for the NULLs), everything else in lists where equal strings share a single
+object. That takes a fraction of the memory of a list of rows, where each row
+and each value is an object of its own.
+"""
+from . import memory
+from . import printer
+from . import streams
+from array import array
+from datetime import datetime, date, time
+from pyodbc import ProgrammingError
+import decimal
+import operator as op
+import sys
+
+_config = {}
+
+_batch_size = 10000
+
+# The resultset kept, and the positions of its rows after :keep where and sort.
+# A view of None means all the rows, in the original order
+_table = None
+_view = None
+_filters = []
+
+_operators = {"=": op.eq,
+              "!=": op.ne,
+              "<": op.lt,
+              "<=": op.le,
+              ">": op.gt,
+              ">=": op.ge,
+              "~": None}
+
+_aggregates = ("count", "sum", "avg", "min", "max")
+
+_numeric_types = (bool, int, float, decimal.Decimal)
+
+# The formats accepted by :keep where for date and time columns
+_datetime_formats = {
+    datetime: ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S.%f",
+               "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S",
+               "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M", "%Y-%m-%d"),
+    date: ("%Y-%m-%d",),
+    time: ("%H:%M:%S.%f", "%H:%M:%S", "%H:%M")}
+
+
+def initialize_module(config):
+    """Initialize this module with a reference to the global config."""
+    global _config
+    _config = config
+
+
+def keep(cursor):
+    """Load all the rows of cursor in the store, and print them as usual.
+
+    Each resultset replaces the previous one, so the last one is what's kept.
+    """
+    global _table, _view, _filters
+    while True:
+        try:
+            # No description means it wasn't a query (UPDATE, etc.)
+            if cursor.description:
+                table = _load(cursor)
+                _table, _view, _filters = table, None, []
+                _print_kept(table)
+        except ProgrammingError as e:
+            if "Previous SQL was not a query." not in str(e):
+                raise e
+        if not cursor.nextset():
+            return
+
+
+def is_loaded():
+    """True if there are results kept."""
+    return _table is not None
+
+
+def summary():
+    """Describe the results kept, for :keep."""
+    if not _table:
+        return "No results kept."
+    text = (f"Kept {_table.row_count} rows, {len(_table.columns)} columns, "
+            f"{memory.format_size(_table.size())}.")
+    if _filters:
+        text += f" Filters: {' AND '.join(_filters)}."
+    return text
+
+
+def sort(keys):
+    """Sort the rows by keys, a list of (column name, descending).
+
+    NULLs go first, same as in SQL Server. The order is kept for the
+    following operations, until :keep where OFF.
+    """
+    global _view
+    positions = list(_positions())
+    # Sorts are stable, so sorting by each key from the last to the first
+    # gives the right order
+    for name, descending in reversed(keys):
+        column = _table.column(name)
+        positions.sort(key=column.sort_key(), reverse=descending)
+    _view = array('q', positions)
+    top(_config["rows_to_print"])
+
+
+def where(name, operator, text):
+    """Keep only the rows where the column compares true against text.
+
+    The text is converted to the type of the column, except for "~" which
+    checks if the value contains text, ignoring case. Comparing against NULL
+    only works with = and !=, same as IS [NOT] NULL.
+    Filters add up, until :keep where OFF.
+    """
+    global _view, _filters
+    if operator not in _operators:
+        raise ValueError(f"Unknown operator {operator}, use one of "
+                         f"{', '.join(_operators)}.")
+    column = _table.column(name)
+    compare = _operators[operator]
+    if text.upper() == "NULL":
+        if operator not in ("=", "!="):
+            raise ValueError("NULL can only be used with = and !=.")
+        wanted = operator == "="
+        positions = [position for position in _positions()
+                     if (column.get(position) is None) == wanted]
+    else:
+        if compare is None:
+            lower_text = text.lower()
+
+            def matches(value):
+                return lower_text in str(value).lower()
+        else:
+            target = column.parse(text)
+
+            def matches(value):
+                return compare(value, target)
+        positions = []
+        for position in _positions():
+            value = column.get(position)
+            if value is not None and matches(value):
+                positions.append(position)
+    _view = array('q', positions)
+    _filters.append(f"{name} {operator} {text}")
+    top(_config["rows_to_print"])
+
+
+def reset():
+    """Go back to all the rows kept, in the original order."""
+    global _view, _filters
+    _view = None
+    _filters = []
+    print(summary())
+
+
+def group(name, aggregate="count", target_name=None):
+    """Print the distinct values of a column, with a row count.
+
+    With target_name, also compute the aggregate of that column for each
+    group. NULLs are ignored by the aggregates, same as in SQL.
+    """
+    if aggregate not in _aggregates:
+        raise ValueError(f"Unknown aggregate {aggregate}, use one of "
+                         f"{', '.join(_aggregates)}.")
+    column = _table.column(name)
+    target = _table.column(target_name) if target_name else None
+    if aggregate in ("sum", "avg") and not target.is_numeric():
+        raise ValueError(f"Can't {aggregate} column {target_name}, "
+                         f"it isn't numeric.")
+    # Each group is [rows, values, sum, min, max]
+    groups = {}
+    for position in _positions():
+        key = column.get(position)
+        stats = groups.get(key)
+        if stats is None:
+            stats = groups[key] = [0, 0, None, None, None]
+        stats[0] += 1
+        if target is None:
+            continue
+        value = target.get(position)
+        if value is None:
+            continue
+        stats[1] += 1
+        if aggregate in ("sum", "avg"):
+            stats[2] = value if stats[2] is None else stats[2] + value
+        elif aggregate == "min":
+            stats[3] = value if stats[3] is None else min(stats[3], value)
+        elif aggregate == "max":
+            stats[4] = value if stats[4] is None else max(stats[4], value)
+    column_names = [name, "rows"]
+    if target:
+        column_names.append(f"{aggregate}({target_name})")
+    rows = []
+    for key in sorted(groups, key=_null_first):
+        stats = groups[key]
+        row = (key, stats[0])
+        if target:
+            row += (_aggregate_value(aggregate, stats),)
+        rows.append(row)
+    rows_to_print = _config["rows_to_print"]
+    printer.print_table(column_names, rows[:rows_to_print or None])
+    print("\nGroups printed: ", min(len(rows), rows_to_print or len(rows)),
+          "/", len(rows), sep="")
+
+
+def top(count):
+    """Print the first count rows (0 for all) after the filters and sort."""
+    positions = _positions()
+    total = len(positions)
+    if count:
+        positions = positions[:count]
+    printer.print_table(_table.names, list(_table.rows(positions)))
+    print("\nRows printed: ", len(positions), "/", total, sep="")
+
+
+def _print_kept(table):
+    """Print the first rows of the table just kept, like any query."""
+    stream = streams.RowStream(table.description,
+                               table.rows(range(table.row_count)))
+    # We know the total, unlike most drivers
+    stream.rowcount = table.row_count
+    # The rest of the rows are a :keep top away, no need for :more
+    printer.print_cursor_results(stream, pageable=False)
+    print("Kept ", table.row_count, " rows in ",
+          memory.format_size(table.size()),
+          ", use :keep sort|where|group|top to explore them.", sep="")
+
+
+def _load(cursor):
+    """Fetch all the rows of the current resultset of cursor in a _Table."""
+    table = _Table(cursor.description)
+    rows = cursor.fetchmany(_batch_size)
+    while rows:
+        table.append_rows(rows)
+        if memory.over_limit():
+            print("\nWARNING: memory ceiling reached after ", table.row_count,
+                  " rows, the rest of the resultset was not kept.", sep="")
+            break
+        rows = cursor.fetchmany(_batch_size)
+    table.finish()
+    return table
+
+
+def _positions():
+    """Positions of the rows in the current view."""
+    if _view is None:
+        return range(_table.row_count)
+    return _view
+
+
+def _null_first(value):
+    return (0, None) if value is None else (1, value)
+
+
+def _parse_datetime(kind, text):
+    """Convert text in ISO format (like 2020-01-31 23:59:00) to kind.
+
+    A date is enough for a datetime, and the seconds are optional.
+    """
+    formats = _datetime_formats[kind]
+    for text_format in formats:
+        try:
+            value = datetime.strptime(text, text_format)
+        except ValueError:
+            continue
+        if kind is date:
+            return value.date()
+        if kind is time:
+            return value.time()
+        return value
+    raise ValueError(f"{text} doesn't match any of {', '.join(formats)}")
+
+
+def _aggregate_value(aggregate, stats):
+    rows, values, total, minimum, maximum = stats
+    if aggregate == "count":
+        return values
+    if aggregate == "sum":
+        return total
+    if aggregate == "avg":
+        return total / values if values else None
+    if aggregate == "min":
+        return minimum
+    return maximum
+
+
+class _Table:
+    """A resultset stored by column."""
+
+    def __init__(self, description):
+        self.description = tuple(description)
+        self.names = [column[0] for column in description]
+        self.columns = [_Column(column[0], column[1])
+                        for column in description]
+        self.row_count = 0
+
+    def append_rows(self, rows):
+        for index, column in enumerate(self.columns):
+            column.extend([row[index] for row in rows])
+        self.row_count += len(rows)
+
+    def finish(self):
+        for column in self.columns:
+            column.finish()
+
+    def column(self, name):
+        """Find a column by name, ignoring case."""
+        for column in self.columns:
+            if column.name.lower() == name.lower():
+                return column
+        raise ValueError(f"There's no column {name} in the results kept.")
+
+    def rows(self, positions):
+        """Generate the rows in positions, as tuples."""
+        columns = self.columns
+        for position in positions:
+            yield tuple(column.get(position) for column in columns)
+
+    def size(self):
+        """Approximate bytes used by the values."""
+        return sum(column.size() for column in self.columns)
+
+
+class _Column:
+    """The values of a column.
+
+    Integer and float columns (per cursor.description) start as arrays. If a
+    value doesn't fit, say a huge integer or a value of another type, the
+    column becomes a list.
+    """
+
+    _typecodes = {int: 'q', float: 'd'}
+
+    def __init__(self, name, type_code):
+        self.name = name
+        self.type_code = type_code
+        typecode = self._typecodes.get(type_code)
+        self._array = array(typecode) if typecode else None
+        self._nulls = bytearray()
+        self._list = None if typecode else []
+        self._unique = {}
+        self._values_size = 0
+
+    def extend(self, values):
+        if self._array is not None:
+            length = len(self._array)
+            type_code = self.type_code
+            # The array would turn True into 1, or 1 into 1.0
+            if all(value is None or type(value) is type_code
+                   for value in values):
+                try:
+                    self._array.extend([0 if value is None else value
+                                        for value in values])
+                    self._nulls.extend([value is None for value in values])
+                    return
+                except OverflowError:
+                    pass
+            self._to_list(length)
+        # Only strings are deduplicated, other values can be equal and still
+        # print differently, like Decimal("1.00") and 1, or True and 1.0
+        unique = self._unique
+        self._list.extend([unique.setdefault(value, value)
+                           if type(value) is str else value
+                           for value in values])
+
+    def finish(self):
+        """Stop deduplicating values, the dictionary isn't needed anymore."""
+        if self._list is not None:
+            self._values_size = (
+                sum(sys.getsizeof(value) for value in self._unique)
+                + sum(sys.getsizeof(value) for value in self._list
+                      if value is not None and type(value) is not str))
+        self._unique = None
+
+    def get(self, position):
+        if self._array is None:
+            return self._list[position]
+        if self._nulls[position]:
+            return None
+        return self._array[position]
+
+    def sort_key(self):
+        if self._array is None:
+            values = self._list
+            return lambda position: _null_first(values[position])
+        values, nulls = self._array, self._nulls
+        if not any(nulls):
+            return values.__getitem__
+        return lambda position: ((0, 0) if nulls[position]
+                                 else (1, values[position]))
+
+    def is_numeric(self):
+        if self._array is not None:
+            return True
+        return (self.type_code in _numeric_types
+                or all(isinstance(value, _numeric_types)
+                       for value in self._list if value is not None))
+
+    def parse(self, text):
+        """Convert text to the type of the column, to compare it."""
+        kind = self.type_code
+        if kind is None or kind is str:
+            # Guess from the values, for drivers that don't tell
+            kind = next((type(value) for value in self._values()
+                         if value is not None), str)
+        try:
+            if kind is bool:
+                return text.lower() in ("1", "true", "yes", "on")
+            if kind in (int, float, decimal.Decimal):
+                return kind(text)
+            if kind in (datetime, date, time):
+                return _parse_datetime(kind, text)
+            if kind is bytes:
+                return bytes.fromhex(text[2:] if text.startswith("0x")
+                                     else text)
+        except (ValueError, ArithmeticError):
+            raise ValueError(f'"{text}" is not a valid value for column '
+                             f'{self.name}.')
+        return text
+
+    def size(self):
+        if self._array is not None:
+            return (self._array.buffer_info()[1] * self._array.itemsize
+                    + len(self._nulls))
+        return sys.getsizeof(self._list) + self._values_size
+
+    def _values(self):
+        return self._array if self._array is not None else self._list
+
+    def _to_list(self, length):
+        """Move the values to a list, only the first length are valid."""
+        self._list = [None if self._nulls[position] else self._array[position]
+                      for position in range(length)]
+        self._unique = {}
+        self._array = None
+        self._nulls = bytearray()
@@ -0,0 +1,46 @@
+"""Cursor look-alikes, for results that don't come from a single cursor.
+
+The printer and the exporter only use a handful of cursor members: the
+description, rowcount, fetchone/fetchmany/fetchall and nextset. Commands that
+produce rows on their own (for example, by combining several cursors) wrap
+them in a RowStream, and then print or export them like any other resultset.
+"""
+import itertools
+
+
+class RowStream:
+    """A single resultset, with the rows produced by any iterable.
+
+    Rows are pulled from the iterable only as they are fetched, so generators
+    keep working in constant memory no matter how big the "resultset" is.
+    """
+
+    def __init__(self, description, rows):
+        self.description = description
+        # Same as most drivers: we don't know the total until we're done
+        self.rowcount = -1
+        self._rows = iter(rows)
+
+    def fetchone(self):
+        """Return the next row, or None when there are no more rows."""
+        return next(self._rows, None)
+
+    def fetchmany(self, size=1):
+        """Return a list with up to size rows."""
+        return list(itertools.islice(self._rows, size))
+
+    def fetchall(self):
+        """Return a list with all the remaining rows."""
+        return list(self._rows)
+
+    def nextset(self):
+        """There's always a single resultset."""
+        return False
+
+
+def column(name, type_code=str):
+    """Build a description entry for a column that isn't in a resultset.
+
+    The tuple has the same shape as those in cursor.description.
+    """
+    return (name, type_code, None, None, None, None, True)
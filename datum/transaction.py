@@ -0,0 +1,170 @@
+"""Run scripts in explicit transactions, committing every few statements.
+
+With autocommit each statement is a transaction, and the server flushes its
+log once per statement. For scripts with thousands of INSERT/UPDATE that is
+most of the time spent. Here the script is split in statements, and they are
+committed in batches instead.
+"""
+from . import commands
+from . import connect
+from . import printer
+import re
+
+_config = {}
+
+# A line with just "GO" separates statements, same as in sqlcmd and SSMS
+_go_line = re.compile(r"[ \t]*GO[ \t]*(\r?\n|$)", re.IGNORECASE)
+
+
+def initialize_module(config):
+    """Initialize this module with a reference to the global config."""
+    global _config
+    _config = config
+
+
+def run(query, params, batch_size, semicolons):
+    """Execute each statement of query, committing every batch_size of them.
+
+    Statements are separated by GO lines, and by ";" if semicolons is True.
+    The params are handed to the statements in order, as many as each one
+    has. If a statement fails, the statements since the last commit are
+    rolled back, and the rest of the script doesn't run.
+    Returns the total of rows affected.
+    """
+    statements = split_statements(query, semicolons)
+    if not statements:
+        print("There are no statements to run.")
+        return 0
+    connection = connect.get_connection()
+    # One cursor for the whole script, so repeated statements are prepared once
+    cursor = connection.cursor()
+    if len(statements) > 1:
+        print('Running ', len(statements), ' statements in batches of ',
+              batch_size, ', one ! per batch committed:', sep="")
+    rows_affected = 0
+    batches = 0
+    batch_start = 0
+    param_index = 0
+    for number, (statement, line) in enumerate(statements):
+        param_count = commands.count_parameters(statement)
+        statement_params = params[param_index:param_index + param_count]
+        param_index += param_count
+        batch_full = number + 1 - batch_start == batch_size
+        try:
+            cursor.execute(statement.strip(), statement_params)
+            if cursor.rowcount > 0:
+                rows_affected += cursor.rowcount
+            if cursor.description:
+                printer.print_cursor_results(cursor, pageable=False)
+            if batch_full:
+                connection.commit()
+        except Exception:
+            connection.rollback()
+            _print_failure(statement, line, number, batches, batch_start)
+            raise
+        if batch_full:
+            batches += 1
+            batch_start = number + 1
+            if len(statements) > 1:
+                print("!", end="", flush=True)
+    if batch_start < len(statements):
+        try:
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            _print_failure(statements[-1][0], statements[-1][1],
+                           len(statements) - 1, batches, batch_start)
+            raise
+        batches += 1
+    if len(statements) > 1:
+        print("\nCommitted ", len(statements), " statements in ", batches,
+              " batch", "es" if batches > 1 else "", ".", sep="")
+    else:
+        print("\nCommitted.")
+    return rows_affected
+
+
+def _print_failure(statement, line, number, batches, batch_start):
+    """Tell the user where the script stopped, and what was committed."""
+    first_line = statement.strip().splitlines()[0]
+    print("\nStatement ", number + 1, " (line ", line, ") failed: ",
+          printer.text_formatter(first_line), sep="")
+    print("Rolled back batch ", batches + 1, ", statements ", batch_start + 1,
+          " to ", number + 1, ". Committed before the error: ", batch_start,
+          " statements in ", batches, " batches.", sep="")
+
+
+def split_statements(text, semicolons=False):
+    """Split a script in statements, at "GO" lines and optionally at ";".
+
+    GO is what sqlcmd and SSMS use. Splitting at ";" isn't safe for compound
+    statements, like CREATE PROCEDURE or BEGIN...END blocks, which have ";"
+    inside them.
+    Separators inside quotes, [identifiers] and comments don't count, and
+    statements that are only whitespace or comments are dropped.
+    Returns a list of (statement, line where its code starts). The text of
+    the statements isn't modified, so they have the same ? as the script.
+    """
+    statements = []
+    start = 0
+    code_line = None
+    line = 1
+    index = 0
+    while index < len(text):
+        if index == 0 or text[index - 1] == "\n":
+            go = _go_line.match(text, index)
+            if go:
+                if code_line:
+                    statements.append((text[start:index], code_line))
+                code_line = None
+                index = start = go.end()
+                line += 1
+                continue
+        char = text[index]
+        pair = text[index:index + 2]
+        if char == ";" and semicolons:
+            if code_line:
+                statements.append((text[start:index], code_line))
+            code_line = None
+            index = start = index + 1
+            continue
+        if pair == "--":
+            end = _find(text, "\n", index + 2)
+        elif pair == "/*":
+            end = _find(text, "*/", index + 2) + 2
+        elif char in ("'", '"', "["):
+            if not code_line:
+                code_line = line
+            end = _closing_quote(text, index)
+        else:
+            if not code_line and not char.isspace():
+                code_line = line
+            if char == "\n":
+                line += 1
+            index += 1
+            continue
+        line += text.count("\n", index, end)
+        index = end
+    if code_line:
+        statements.append((text[start:], code_line))
+    return statements
+
+
+def _find(text, substring, start):
+    """Like str.find, but not finding it means the end of the text."""
+    position = text.find(substring, start)
+    return len(text) if position == -1 else position
+
+
+def _closing_quote(text, index):
+    """Return the position after the quote that closes the one at index.
+
+    Quotes are escaped by doubling them: 'it''s', "a""b" and [a]]b].
+    """
+    closing = "]" if text[index] == "[" else text[index]
+    position = index + 1
+    while True:
+        position = _find(text, closing, position)
+        if text[position + 1:position + 2] != closing:
+            return min(position + 1, len(text))
+        position += 2
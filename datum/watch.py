@@ -0,0 +1,114 @@
+"""Run a query repeatedly, printing only what changed since the last run.
+
+Meant for monitoring queries (blocking sessions, queue depths...). Rows are
+matched by the key columns, and the output is proportional to the changes
+rather than to the size of the results.
+"""
+from . import connect
+from . import printer
+from datetime import datetime
+import time
+
+_config = {}
+
+_batch_size = 10000
+
+
+def initialize_module(config):
+    """Initialize this module with a reference to the global config."""
+    global _config
+    _config = config
+
+
+def run(query, params, interval, keys):
+    """Execute query every interval seconds until the user presses Ctrl-C.
+
+    The first run prints the results as usual. After that only the rows that
+    were inserted (+), removed (-) or changed (~) are printed, with a summary
+    line. Runs with no changes print nothing.
+    keys are the names of the columns that identify a row, if empty the whole
+    row is the key.
+    Returns the row count of the last run.
+    """
+    global _config
+    # The same cursor is used for all runs, so the statement is prepared once
+    cursor = connect.get_connection().cursor()
+    previous = None
+    print("Running every", interval, "seconds, press Ctrl-C to stop.")
+    try:
+        while True:
+            start = time.perf_counter()
+            cursor.execute(query, params)
+            column_names = [column[0] for column in cursor.description]
+            current = _snapshot(cursor, _key_indexes(column_names, keys))
+            elapsed = time.perf_counter() - start
+            if previous is None:
+                rows = list(current.values())
+                rows_to_print = _config["rows_to_print"]
+                printer.print_table(column_names, rows[:rows_to_print or None])
+                print("\n", _timestamp(), " ", len(rows), " rows (",
+                      f"{elapsed:.2f}s", ")", sep="", flush=True)
+            else:
+                _print_changes(column_names, previous, current, elapsed)
+            previous = current
+            time.sleep(max(interval - elapsed, 0))
+    except KeyboardInterrupt:
+        # If we were in the middle of a query, don't leave it running in the
+        # server
+        cursor.cancel()
+        print("\nStopped.")
+    return len(previous) if previous is not None else -1
+
+
+def _key_indexes(column_names, keys):
+    """Positions of the key columns, or None to use the whole row."""
+    if not keys:
+        return None
+    lower_names = [name.lower() for name in column_names]
+    try:
+        return [lower_names.index(key.lower()) for key in keys]
+    except ValueError:
+        raise ValueError("All the key columns must be part of the results.")
+
+
+def _snapshot(cursor, key_indexes):
+    """Fetch all rows in a dictionary of key => row.
+
+    If a key is repeated, the rows are told apart by how many times the key
+    was seen before.
+    """
+    snapshot = {}
+    seen = {}
+    rows = cursor.fetchmany(_batch_size)
+    while rows:
+        for row in rows:
+            row = tuple(row)
+            if key_indexes is None:
+                key = row
+            else:
+                key = tuple(row[index] for index in key_indexes)
+            occurrence = seen.get(key, 0)
+            seen[key] = occurrence + 1
+            snapshot[(key, occurrence)] = row
+        rows = cursor.fetchmany(_batch_size)
+    return snapshot
+
+
+def _print_changes(column_names, previous, current, elapsed):
+    """Print the rows that differ between two snapshots, and a summary."""
+    inserted = [("+", *row) for key, row in current.items()
+                if key not in previous]
+    removed = [("-", *row) for key, row in previous.items()
+               if key not in current]
+    changed = [("~", *row) for key, row in current.items()
+               if key in previous and previous[key] != row]
+    if not (inserted or removed or changed):
+        return
+    printer.print_table(["", *column_names], removed + changed + inserted)
+    print("\n", _timestamp(), " ", len(inserted), " inserted, ",
+          len(removed), " removed, ", len(changed), " changed, ",
+          len(current), " rows (", f"{elapsed:.2f}s", ")", sep="", flush=True)
+
+
+def _timestamp():
+    return datetime.now().strftime("%H:%M:%S")